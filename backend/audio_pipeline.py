@@ -0,0 +1,653 @@
+"""
+In-memory audio pipeline used before speech-to-text.
+
+Uploaded audio is kept in memory: ffmpeg reads it from stdin and writes 16k mono
+WAV to stdout, and that output is streamed straight into the multipart body of
+the upstream STT request. No temp files are written.
+
+SpeechTrimmer is an energy-based voice activity detection stage over 16-bit PCM
+WAV streams: it drops leading/trailing silence and lets callers skip STT for
+recordings without speech. LevelMeter (wav_levels for whole files, metered_wav_stream
+for streams) computes the level statistics (duration, RMS, peak, clipping) used to
+reject unusable recordings.
+"""
+import os
+import sys
+import math
+import uuid
+import array
+import struct
+import asyncio
+import subprocess
+from collections import deque
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # pure-python fallback below
+    np = None
+
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+PIPE_CHUNK_SIZE = 64 * 1024
+
+# 16k mono WAV is what ElevenLabs STT handles best
+FFMPEG_WAV_ARGS = ["-hide_banner", "-loglevel", "error", "-i", "pipe:0", "-ar", "16000", "-ac", "1", "-f", "wav", "pipe:1"]
+
+
+class TranscodeError(RuntimeError):
+    pass
+
+
+class AudioQualityError(ValueError):
+    """Recording rejected before STT; reason is "too_short", "silent" or "clipped"."""
+
+    def __init__(self, reason: str, levels: Dict[str, float]):
+        super().__init__(f"audio rejected: {reason}")
+        self.reason = reason
+        self.levels = levels
+
+
+# sniffed format -> (file extension, content type) used when forwarding untouched
+FORMAT_MEDIA = {
+    "wav": (".wav", "audio/wav"),
+    "flac": (".flac", "audio/flac"),
+    "mp3": (".mp3", "audio/mpeg"),
+    "aac": (".aac", "audio/aac"),
+    "ogg": (".ogg", "audio/ogg"),
+    "webm": (".webm", "audio/webm"),
+    "mp4": (".m4a", "audio/mp4"),
+}
+
+
+def sniff_audio_format(data: bytes) -> Optional[str]:
+    """
+    Identify the container (and codec where cheap) from the first bytes of an upload.
+    Returns e.g. "wav/pcm", "webm/opus", "ogg/vorbis", "mp3", "mp4" or None if unknown.
+    """
+    head = data[:4096]
+    if len(head) >= 12 and head[0:4] == b"RIFF" and head[8:12] == b"WAVE":
+        # fmt chunk normally directly follows; audio format 1 = PCM
+        if head[12:16] == b"fmt " and len(head) >= 22:
+            return "wav/pcm" if int.from_bytes(head[20:22], "little") in (1, 0xFFFE) else "wav"
+        return "wav"
+    if head.startswith(b"fLaC"):
+        return "flac"
+    if head.startswith(b"OggS"):
+        if b"OpusHead" in head:
+            return "ogg/opus"
+        if b"\x01vorbis" in head:
+            return "ogg/vorbis"
+        return "ogg"
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        # EBML: webm/matroska; codec id is in the track header near the start
+        container = "webm" if b"webm" in head[:64] else "mkv"
+        if b"A_OPUS" in head:
+            return f"{container}/opus"
+        if b"A_VORBIS" in head:
+            return f"{container}/vorbis"
+        return container
+    if len(head) >= 8 and head[4:8] == b"ftyp":
+        return "mp4"
+    if head.startswith(b"ID3"):
+        return "mp3"
+    if len(head) >= 2 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0:
+        # ADTS AAC shares the sync word but has layer bits 00
+        return "aac" if (head[1] & 0x06) == 0 else "mp3"
+    return None
+
+
+def format_allowed(fmt: Optional[str], allow_list) -> bool:
+    """True if fmt (container or container/codec) matches an allow-list entry."""
+    if not fmt:
+        return False
+    return fmt in allow_list or fmt.split("/")[0] in allow_list
+
+
+def media_for_format(fmt: str) -> Tuple[str, str]:
+    return FORMAT_MEDIA.get(fmt.split("/")[0], (".bin", "application/octet-stream"))
+
+
+async def iter_bytes(data: bytes, chunk_size: int = PIPE_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Expose in-memory audio as an async chunk stream."""
+    for i in range(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
+
+
+async def _feed_stdin(proc: asyncio.subprocess.Process, data: bytes) -> None:
+    try:
+        proc.stdin.write(data)
+        await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg gave up on the input; the exit code tells the reader
+        pass
+    finally:
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+
+
+class ProcessOutput:
+    """
+    Async iterator over a running ffmpeg's stdout. aclose() reaps the process even
+    when the output was never consumed (e.g. the upstream request failed early).
+    """
+
+    def __init__(self, proc: asyncio.subprocess.Process, first: bytes, feeder: "asyncio.Future"):
+        self._proc = proc
+        self._first = first
+        self._feeder = feeder
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._iter()
+
+    async def _iter(self) -> AsyncIterator[bytes]:
+        try:
+            yield self._first
+            while True:
+                chunk = await self._proc.stdout.read(PIPE_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            code = await self._proc.wait()
+            if code != 0:
+                raise TranscodeError(f"ffmpeg exited with code {code}")
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        if self._proc.returncode is None:
+            try:
+                self._proc.kill()
+            except ProcessLookupError:
+                pass
+            await self._proc.wait()
+        if not self._feeder.done():
+            self._feeder.cancel()
+
+
+async def transcode_to_wav_stream(data: bytes):
+    """
+    Pipe audio through ffmpeg and return an async iterator (with aclose()) over the WAV output.
+    Returns None when ffmpeg is unavailable or can't decode the input (e.g. MP4
+    with its index at the end, which needs a seekable input) so the caller can
+    send the original bytes instead.
+    """
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_BIN, *FFMPEG_WAV_ARGS,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    except NotImplementedError:
+        # event loops without subprocess support (e.g. Windows selector loop)
+        return await _transcode_in_thread(data)
+    except OSError as e:
+        print("Warning: ffmpeg transcode failed or not available:", e)
+        return None
+
+    feeder = asyncio.ensure_future(_feed_stdin(proc, data))
+    first = await proc.stdout.read(PIPE_CHUNK_SIZE)
+    if not first:
+        await feeder
+        code = await proc.wait()
+        print("Warning: ffmpeg produced no output, exit code", code)
+        return None
+    return ProcessOutput(proc, first, feeder)
+
+
+async def _transcode_in_thread(data: bytes) -> Optional[AsyncIterator[bytes]]:
+    def run() -> Optional[bytes]:
+        try:
+            done = subprocess.run([FFMPEG_BIN, *FFMPEG_WAV_ARGS], input=data, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            print("Warning: ffmpeg transcode failed or not available:", e)
+            return None
+        return done.stdout if done.returncode == 0 and done.stdout else None
+
+    out = await asyncio.to_thread(run)
+    return iter_bytes(out) if out else None
+
+
+class ReplayableStream:
+    """
+    Lets several consumers read one chunk stream from the start (e.g. a hedged second
+    upload of the same audio). The source is pulled once; chunks are kept for replay.
+    """
+
+    def __init__(self, source):
+        self._it = source.__aiter__()
+        self._chunks: List[bytes] = []
+        self._done = False
+        self._error: Optional[BaseException] = None
+        self._lock = asyncio.Lock()
+
+    async def reader(self) -> AsyncIterator[bytes]:
+        i = 0
+        while True:
+            if i < len(self._chunks):
+                yield self._chunks[i]
+                i += 1
+                continue
+            if self._error is not None:
+                raise self._error
+            if self._done:
+                return
+            async with self._lock:
+                if i < len(self._chunks) or self._done or self._error is not None:
+                    continue
+                try:
+                    chunk = await self._it.__anext__()
+                except StopAsyncIteration:
+                    self._done = True
+                    continue
+                except Exception as e:
+                    self._error = e
+                    raise
+                self._chunks.append(chunk)
+
+
+def multipart_stream(
+    fields: Dict[str, str], file_field: str, filename: str, content_type: str, chunks: AsyncIterator[bytes]
+) -> Tuple[AsyncIterator[bytes], str]:
+    """
+    Build a multipart/form-data body whose file part is streamed from chunks.
+    Returns (body iterator, Content-Type header value).
+    """
+    boundary = uuid.uuid4().hex
+    head = b"".join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode("utf-8")
+        for name, value in fields.items()
+    )
+    head += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    async def body() -> AsyncIterator[bytes]:
+        yield head
+        async for chunk in chunks:
+            if chunk:
+                yield chunk
+        yield tail
+
+    return body(), f"multipart/form-data; boundary={boundary}"
+
+
+def parse_wav_header(buf: bytes) -> Optional[Tuple[int, int, int, int, int]]:
+    """
+    Parse a RIFF/WAVE header up to the start of the data chunk.
+    Returns (audio format, channels, sample rate, bits per sample, data offset), None
+    when more bytes are needed. Raises ValueError if buf is not a WAV header.
+    """
+    if len(buf) < 12:
+        return None
+    if buf[0:4] != b"RIFF" or buf[8:12] != b"WAVE":
+        raise ValueError("not a RIFF/WAVE stream")
+    pos = 12
+    fmt = None
+    while len(buf) >= pos + 8:
+        chunk_id = buf[pos:pos + 4]
+        size = int.from_bytes(buf[pos + 4:pos + 8], "little")
+        if chunk_id == b"data":
+            if fmt is None:
+                raise ValueError("data chunk before fmt chunk")
+            return fmt[0], fmt[1], fmt[2], fmt[3], pos + 8
+        if chunk_id == b"fmt ":
+            if len(buf) < pos + 8 + 16:
+                return None
+            audio_format, channels, rate = struct.unpack("<HHI", buf[pos + 8:pos + 16])
+            bits = int.from_bytes(buf[pos + 22:pos + 24], "little")
+            if audio_format == 0xFFFE:
+                audio_format = 1  # WAVE_FORMAT_EXTENSIBLE, PCM subformat assumed
+            fmt = (audio_format, channels, rate, bits)
+        pos += 8 + size + (size & 1)
+    return None
+
+
+def wav_stream_header(channels: int, rate: int) -> bytes:
+    """16-bit PCM WAV header with unknown (streaming) lengths, as ffmpeg writes to pipes."""
+    return (
+        b"RIFF" + b"\xff\xff\xff\xff" + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, rate, rate * channels * 2, channels * 2, 16)
+        + b"data" + b"\xff\xff\xff\xff"
+    )
+
+
+def frame_rms(block: bytes, frame_bytes: int) -> List[float]:
+    """RMS of each frame of 16-bit little-endian PCM in block (the last frame may be short)."""
+    if np is not None:
+        samples = np.frombuffer(block, dtype="<i2", count=len(block) // 2).astype(np.float32)
+        per_frame = frame_bytes // 2
+        full = len(samples) // per_frame
+        out = np.sqrt(np.mean(np.square(samples[:full * per_frame].reshape(full, per_frame)), axis=1)).tolist() if full else []
+        if len(samples) > full * per_frame:
+            out.append(float(np.sqrt(np.mean(np.square(samples[full * per_frame:])))))
+        return out
+    out = []
+    for i in range(0, len(block) - 1, frame_bytes):
+        seg = block[i:i + frame_bytes]
+        samples = array.array("h", seg[:len(seg) // 2 * 2])
+        if sys.byteorder == "big":
+            samples.byteswap()
+        out.append(math.sqrt(sum(x * x for x in samples) / len(samples)) if samples else 0.0)
+    return out
+
+
+class SpeechTrimmer:
+    """
+    Streaming energy-based VAD over a 16-bit PCM WAV byte stream.
+
+    A frame is voiced when its RMS is above threshold_dbfs; speech starts after
+    onset_ms of consecutive voiced frames. Audio before that and silence after the
+    last voiced frame are dropped, keeping pad_ms on either side. Non-PCM16 input is
+    passed through untouched.
+
+    Call start() first: it reads until speech begins and returns False when the
+    recording ends without any, in which case nothing needs to be sent.
+    """
+
+    def __init__(self, source, threshold_dbfs: float = -45.0, pad_ms: int = 250, onset_ms: int = 90, frame_ms: int = 30):
+        self._source = source
+        self._it = source.__aiter__()
+        self._threshold = 32768.0 * 10 ** (threshold_dbfs / 20.0)
+        self._pad_ms, self._onset_ms, self._frame_ms = pad_ms, onset_ms, frame_ms
+        self._buf = bytearray()
+        self._eof = False
+        self._header: Optional[bytes] = None
+        self._passthrough = False
+        self._frame_bytes = 0
+        self._bytes_per_ms = 0.0
+        self._pad_frames = self._onset_frames = 1
+        self._ring: deque = deque()
+        self._run = 0
+        self._in_speech = False
+        self._held: List[bytes] = []
+        self._out: List[bytes] = []
+        self.input_bytes = 0
+        self.sent_bytes = 0
+
+    async def _pull(self) -> bool:
+        if self._eof:
+            return False
+        try:
+            chunk = await self._it.__anext__()
+        except StopAsyncIteration:
+            self._eof = True
+            return False
+        self._buf.extend(chunk)
+        return True
+
+    async def _read_header(self) -> bool:
+        while self._header is None and not self._passthrough:
+            try:
+                parsed = parse_wav_header(bytes(self._buf))
+            except ValueError:
+                self._passthrough = True
+                break
+            if parsed is not None:
+                audio_format, channels, rate, bits, offset = parsed
+                if audio_format != 1 or bits != 16 or not channels or not rate:
+                    self._passthrough = True
+                    break
+                self._header = wav_stream_header(channels, rate)
+                del self._buf[:offset]
+                self._bytes_per_ms = rate * channels * 2 / 1000.0
+                self._frame_bytes = max(2, int(rate * self._frame_ms / 1000)) * channels * 2
+                self._pad_frames = max(1, self._pad_ms // self._frame_ms)
+                self._onset_frames = max(1, self._onset_ms // self._frame_ms)
+                self._ring = deque(maxlen=self._pad_frames + self._onset_frames)
+                break
+            if not await self._pull():
+                self._passthrough = bool(self._buf)
+                break
+        return self._header is not None or self._passthrough
+
+    def _feed(self, frame: bytes, voiced: bool) -> None:
+        self.input_bytes += len(frame)
+        if not self._in_speech:
+            self._ring.append(frame)
+            self._run = self._run + 1 if voiced else 0
+            if self._run >= self._onset_frames:
+                self._in_speech = True
+                self._out.extend(self._ring)
+                self._ring.clear()
+        elif voiced:
+            self._out.extend(self._held)
+            self._held.clear()
+            self._out.append(frame)
+        else:
+            self._held.append(frame)
+
+    def _process(self, final: bool = False) -> None:
+        fb = self._frame_bytes
+        n = len(self._buf) if final else len(self._buf) // fb * fb
+        if n <= 0:
+            return
+        block = bytes(self._buf[:n])
+        del self._buf[:n]
+        for i, rms in enumerate(frame_rms(block, fb)):
+            self._feed(block[i * fb:(i + 1) * fb], rms >= self._threshold)
+        if final and self._in_speech:
+            self._out.extend(self._held[:self._pad_frames])
+            self._held.clear()
+
+    def _take(self) -> bytes:
+        out = b"".join(self._out)
+        self._out.clear()
+        self.sent_bytes += len(out)
+        return out
+
+    async def start(self) -> bool:
+        """Read until speech starts. Returns False if the recording has no speech."""
+        if not await self._read_header():
+            return False
+        if self._passthrough:
+            return True
+        while not self._in_speech:
+            self._process()
+            if self._in_speech:
+                break
+            if not await self._pull():
+                self._process(final=True)
+                break
+        return self._in_speech
+
+    @property
+    def has_speech(self) -> bool:
+        return self._in_speech or self._passthrough
+
+    def __aiter__(self) -> AsyncIterator[bytes]:
+        return self._iter()
+
+    async def _iter(self) -> AsyncIterator[bytes]:
+        try:
+            if self._passthrough:
+                if self._buf:
+                    yield bytes(self._buf)
+                    self._buf.clear()
+                async for chunk in self._it:
+                    yield chunk
+                return
+            yield self._header + self._take()
+            while await self._pull():
+                self._process()
+                if self._out:
+                    yield self._take()
+            self._process(final=True)
+            tail = self._take()
+            if tail:
+                yield tail
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        closer = getattr(self._source, "aclose", None)
+        if closer is not None:
+            await closer()
+
+    def report(self) -> Dict[str, int]:
+        """Milliseconds of audio analysed, sent and trimmed (zeros for passthrough input)."""
+        if not self._bytes_per_ms:
+            return {"input_ms": 0, "sent_ms": 0, "trimmed_ms": 0}
+        input_ms = int(self.input_bytes / self._bytes_per_ms)
+        sent_ms = int(self.sent_bytes / self._bytes_per_ms)
+        return {"input_ms": input_ms, "sent_ms": sent_ms, "trimmed_ms": max(0, input_ms - sent_ms)}
+
+
+class LevelMeter:
+    """
+    Incremental level statistics over interleaved integer PCM, fed chunk by chunk:
+    duration, RMS, peak and the share of clipped samples. Channels are mixed down to
+    mono first; 8-bit samples are unsigned, 16/32-bit signed little-endian.
+
+    The gate is the only consumer, and its thresholds are in dBFS, so levels here are
+    relative to full scale for what STT hears: 8-bit is centred on 128 and channels
+    are averaged. analyze_wav.py and inspect_wav.py deliberately do not share this;
+    they are debugging aids that print raw sample values as stored (8-bit uncentred,
+    inspect_wav per channel), so their peak/RMS will not match these figures.
+    """
+
+    _TYPES = {1: ("B", "u1"), 2: ("h", "<i2"), 4: ("i", "<i4")}
+
+    def __init__(self, rate: int, channels: int = 1, sample_width: int = 2, clip_level: float = 0.99):
+        if sample_width not in self._TYPES:
+            raise ValueError(f"unsupported sample width: {sample_width}")
+        self.rate = rate
+        self.channels = max(1, channels)
+        self.sample_width = sample_width
+        self.full_scale = float(1 << (8 * sample_width - 1))
+        self._clip_at = self.full_scale * clip_level
+        self._rest = b""
+        self.samples = 0
+        self.peak = 0.0
+        self.clipped = 0
+        self._sum_sq = 0.0
+
+    def add(self, data: bytes) -> None:
+        data = self._rest + data
+        frame = self.sample_width * self.channels
+        n = len(data) // frame * frame
+        self._rest = data[n:]
+        if not n:
+            return
+        typecode, dtype = self._TYPES[self.sample_width]
+        if np is not None:
+            x = np.frombuffer(data, dtype=dtype, count=n // self.sample_width).astype(np.float64)
+            if self.sample_width == 1:
+                x -= 128.0
+            if self.channels > 1:
+                x = x.reshape(-1, self.channels).mean(axis=1)
+            mags = np.abs(x)
+            self.samples += int(x.size)
+            self._sum_sq += float(np.dot(x, x))
+            self.peak = max(self.peak, float(mags.max()))
+            self.clipped += int(np.count_nonzero(mags >= self._clip_at))
+            return
+        vals = array.array(typecode, data[:n])
+        if sys.byteorder == "big" and self.sample_width > 1:
+            vals.byteswap()
+        offset = 128 if self.sample_width == 1 else 0
+        ch = self.channels
+        for i in range(0, len(vals), ch):
+            v = (sum(vals[i:i + ch]) / ch) - offset
+            m = abs(v)
+            self.samples += 1
+            self._sum_sq += v * v
+            if m > self.peak:
+                self.peak = m
+            if m >= self._clip_at:
+                self.clipped += 1
+
+    def result(self) -> Dict[str, float]:
+        rms = math.sqrt(self._sum_sq / self.samples) if self.samples else 0.0
+
+        def dbfs(v: float) -> float:
+            return round(20 * math.log10(v / self.full_scale), 2) if v > 0 else -120.0
+
+        return {
+            "duration_s": round(self.samples / self.rate, 3) if self.rate else 0.0,
+            "rms": round(rms, 3),
+            "rms_dbfs": dbfs(rms),
+            "peak": int(self.peak),
+            "peak_dbfs": dbfs(self.peak),
+            "clipped_ratio": round(self.clipped / self.samples, 5) if self.samples else 0.0,
+        }
+
+
+def quality_problem(levels: Dict[str, float], min_duration_s: float, min_peak_dbfs: float, max_clipped_ratio: float) -> Optional[str]:
+    """Reason a recording is not worth transcribing, or None."""
+    if levels["duration_s"] < min_duration_s:
+        return "too_short"
+    if levels["peak_dbfs"] < min_peak_dbfs:
+        return "silent"
+    if levels["clipped_ratio"] > max_clipped_ratio:
+        return "clipped"
+    return None
+
+
+def _meter_for(parsed: Tuple[int, int, int, int, int]) -> Optional[LevelMeter]:
+    audio_format, channels, rate, bits, _ = parsed
+    if audio_format == 1 and bits // 8 in LevelMeter._TYPES and rate:
+        return LevelMeter(rate, channels, bits // 8)
+    return None
+
+
+def wav_levels(data: bytes) -> Optional[Dict[str, float]]:
+    """
+    Level statistics of a complete in-memory WAV file (see LevelMeter.result), or None
+    for non-integer-PCM or unparsable input.
+    """
+    try:
+        parsed = parse_wav_header(data)
+    except ValueError:
+        return None
+    meter = _meter_for(parsed) if parsed is not None else None
+    if meter is None:
+        return None
+    meter.add(data[parsed[4]:])
+    return meter.result()
+
+
+async def metered_wav_stream(source, check: Callable[[Optional[Dict[str, float]]], None]) -> AsyncIterator[bytes]:
+    """
+    Pass a WAV byte stream through unchanged, metering the samples as they go by.
+    When the source ends, check(levels) runs before the last chunk is released
+    (levels is None for non-integer-PCM or unparsable input); an exception from it,
+    e.g. AudioQualityError, ends the stream instead, so an upload reading it never
+    completes.
+    """
+    head = bytearray()
+    meter: Optional[LevelMeter] = None
+    usable = True
+    held: Optional[bytes] = None
+    try:
+        async for chunk in source:
+            if meter is not None:
+                meter.add(chunk)
+            elif usable:
+                head.extend(chunk)
+                try:
+                    parsed = parse_wav_header(bytes(head))
+                except ValueError:
+                    parsed, usable = None, False
+                if parsed is not None:
+                    meter = _meter_for(parsed)
+                    if meter is not None:
+                        meter.add(bytes(head[parsed[4]:]))
+                    else:
+                        usable = False
+                if not usable or meter is not None:
+                    head = bytearray()
+            if held is not None:
+                yield held
+            held = chunk
+        check(meter.result() if meter is not None else None)
+        if held is not None:
+            yield held
+    finally:
+        closer = getattr(source, "aclose", None)
+        if closer is not None:
+            await closer()
@@ -0,0 +1,152 @@
+"""
+Joining separately synthesised audio clips into one clip without re-encoding.
+
+MP3 clips are cut at frame boundaries: ID3 tags, the Xing/Info/VBRI header frame
+(whose duration would be wrong for the joined clip) and any trailing partial frame
+are dropped, and the remaining frames are concatenated. PCM WAV clips are joined
+by concatenating their sample data under a new header. Clips are only joined
+when their formats match (MPEG version/layer/sample rate/mono, or WAV format);
+otherwise None is returned and the caller synthesises the text as a whole.
+"""
+import struct
+from typing import List, Optional, Tuple
+
+from .audio_pipeline import parse_wav_header
+
+# kbps by [MPEG-1?][layer 1..3][bitrate index]
+_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# Hz by version bits (3 = MPEG-1, 2 = MPEG-2, 0 = MPEG-2.5)
+_SAMPLE_RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+
+def mp3_frame_header(data: bytes, pos: int) -> Optional[Tuple[int, Tuple[int, int, int, bool]]]:
+    """
+    Parse the MPEG audio frame header at pos.
+    Returns (frame length, (version bits, layer, sample rate, mono)) or None if there is no valid header.
+    """
+    if pos + 4 > len(data):
+        return None
+    b1, b2, b3 = data[pos + 1], data[pos + 2], data[pos + 3]
+    if data[pos] != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version = (b1 >> 3) & 0x3
+    layer = 4 - ((b1 >> 1) & 0x3)
+    bitrate_idx = b2 >> 4
+    rate_idx = (b2 >> 2) & 0x3
+    if version == 1 or layer == 4 or bitrate_idx in (0, 15) or rate_idx == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _BITRATES[(mpeg1, layer)][bitrate_idx] * 1000
+    rate = _SAMPLE_RATES[version][rate_idx]
+    padding = (b2 >> 1) & 0x1
+    if layer == 1:
+        length = (12 * bitrate // rate + padding) * 4
+    elif layer == 3 and not mpeg1:
+        length = 72 * bitrate // rate + padding
+    else:
+        length = 144 * bitrate // rate + padding
+    mono = (b3 >> 6) == 3
+    return length, (version, layer, rate, mono)
+
+
+def _skip_id3v2(data: bytes) -> int:
+    if len(data) < 10 or data[:3] != b"ID3":
+        return 0
+    size = 0
+    for b in data[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    footer = 10 if data[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def mp3_frames(data: bytes) -> Optional[Tuple[bytes, Tuple[int, int, int, bool]]]:
+    """
+    The whole audio frames of an MP3 clip and its stream format, or None if the clip
+    does not start with MPEG audio frames (after an optional ID3v2 tag).
+    """
+    pos = _skip_id3v2(data)
+    end = len(data)
+    if end - pos >= 128 and data[end - 128:end - 125] == b"TAG":
+        end -= 128  # ID3v1 trailer
+    stream_format = None
+    start = pos
+    first = True
+    while pos < end:
+        header = mp3_frame_header(data, pos)
+        if header is None:
+            break
+        length, fmt = header
+        if pos + length > end:
+            break  # truncated last frame
+        if stream_format is None:
+            stream_format = fmt
+        elif fmt != stream_format:
+            return None
+        if first:
+            first = False
+            if any(tag in data[pos:pos + min(length, 64)] for tag in (b"Xing", b"Info", b"VBRI")):
+                start = pos + length
+        pos += length
+    if stream_format is None or pos <= start:
+        return None
+    return data[start:pos], stream_format
+
+
+def splice_mp3(parts: List[bytes]) -> Optional[bytes]:
+    out = []
+    stream_format = None
+    for part in parts:
+        frames = mp3_frames(part)
+        if frames is None:
+            return None
+        if stream_format is None:
+            stream_format = frames[1]
+        elif frames[1] != stream_format:
+            return None
+        out.append(frames[0])
+    return b"".join(out) if out else None
+
+
+def splice_wav(parts: List[bytes]) -> Optional[bytes]:
+    out = []
+    wav_format = None
+    for part in parts:
+        try:
+            header = parse_wav_header(part)
+        except ValueError:
+            return None
+        if header is None or header[0] != 1:
+            return None
+        if wav_format is None:
+            wav_format = header[1:4]
+        elif header[1:4] != wav_format:
+            return None
+        block = header[1] * header[3] // 8
+        pcm = part[header[4]:]
+        out.append(pcm[:len(pcm) - len(pcm) % block] if block else pcm)
+    if wav_format is None:
+        return None
+    channels, rate, bits = wav_format
+    data = b"".join(out)
+    block = channels * bits // 8
+    return (
+        b"RIFF" + struct.pack("<I", 36 + len(data)) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, rate, rate * block, block, bits)
+        + b"data" + struct.pack("<I", len(data)) + data
+    )
+
+
+def splice_audio(parts: List[bytes], media_type: str) -> Optional[bytes]:
+    """Join clips of one media type ("audio/mpeg" or "audio/wav"); None if they can't be joined losslessly."""
+    if media_type == "audio/mpeg":
+        return splice_mp3(parts)
+    if media_type == "audio/wav":
+        return splice_wav(parts)
+    return None
@@ -0,0 +1,106 @@
+"""
+Derived claim fields computed from other session fields.
+
+A derived field declares the fields it is computed from. Results are cached per
+session together with the input values they were computed from, so the value is
+only recomputed when one of those inputs changes. Derived fields may depend on
+other derived fields; they are evaluated in dependency order.
+"""
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+def field_value(data: Dict[str, Any], name: str) -> Any:
+    """Read a claim field by its spaced name, accepting the underscore variant too."""
+    return data.get(name) or data.get(name.replace(" ", "_"))
+
+
+class DerivedField:
+    def __init__(self, name: str, inputs: Sequence[str], compute: Callable[..., Any]):
+        """
+        name: claim field the value is written to (spaced form, e.g. "Compensation Amount")
+        inputs: claim fields the value depends on
+        compute: called with the input values in order; returns the value or None
+        """
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.compute = compute
+
+
+class DerivedFieldEngine:
+    def __init__(self, fields: Iterable[DerivedField]):
+        self.fields: Dict[str, DerivedField] = {}
+        for f in fields:
+            self.fields[f.name] = f
+        self.order: List[str] = self._topological_order()
+
+    def _topological_order(self) -> List[str]:
+        order: List[str] = []
+        state: Dict[str, int] = {}
+
+        def visit(name: str) -> None:
+            if state.get(name) == 2:
+                return
+            if state.get(name) == 1:
+                raise ValueError(f"derived field cycle at {name!r}")
+            state[name] = 1
+            for dep in self.fields[name].inputs:
+                if dep in self.fields and dep != name:
+                    visit(dep)
+            state[name] = 2
+            order.append(name)
+
+        for name in self.fields:
+            visit(name)
+        return order
+
+    def _closure(self, names: Iterable[str]) -> List[str]:
+        wanted = set()
+        stack = list(names)
+        while stack:
+            name = stack.pop()
+            if name in wanted or name not in self.fields:
+                continue
+            wanted.add(name)
+            stack.extend(self.fields[name].inputs)
+        return [n for n in self.order if n in wanted]
+
+    def evaluate(self, data: Dict[str, Any], cache: Dict[str, Tuple[tuple, Any]], names: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """
+        Return {name: value} for the requested derived fields (all when names is None),
+        reusing cached values whose inputs are unchanged. Values of derived fields that
+        other derived fields depend on are taken from this evaluation, not from data.
+        """
+        targets = self._closure(names if names is not None else self.order)
+        values: Dict[str, Any] = {}
+        for name in targets:
+            f = self.fields[name]
+            args = tuple(
+                values[dep] if dep in values and dep != name else field_value(data, dep)
+                for dep in f.inputs
+            )
+            entry = cache.get(name)
+            if entry is not None and entry[0] == args:
+                values[name] = entry[1]
+                continue
+            value = f.compute(*args)
+            cache[name] = (args, value)
+            values[name] = value
+        return values
+
+    def fill_missing(self, data: Dict[str, Any], cache: Dict[str, Tuple[tuple, Any]], names: Iterable[str]) -> List[str]:
+        """
+        Write derived values into data (spaced and underscore keys) for the named fields
+        that are still empty. Returns the names that were filled.
+        """
+        missing = [n for n in names if not field_value(data, n)]
+        if not missing:
+            return []
+        values = self.evaluate(data, cache, missing)
+        filled = []
+        for name in missing:
+            value = values.get(name)
+            if value:
+                data[name] = value
+                data[name.replace(" ", "_")] = value
+                filled.append(name)
+        return filled
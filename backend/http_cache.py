@@ -0,0 +1,91 @@
+"""
+HTTP caching for in-memory audio responses: content-hash ETags, conditional GET
+(If-None-Match -> 304), Cache-Control and single byte ranges (Range / If-Range -> 206).
+"""
+import hashlib
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import Response
+
+
+def content_etag(data: bytes) -> str:
+    return '"' + hashlib.blake2b(data, digest_size=16).hexdigest() + '"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match comparison (weak, so W/"x" matches "x")."""
+    if header.strip() == "*":
+        return True
+    bare = etag[2:] if etag.startswith("W/") else etag
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == bare:
+            return True
+    return False
+
+
+def _if_range_matches(header: str, etag: str) -> bool:
+    """If-Range comparison: strong, so a weak tag (or a date, which this doesn't track) never matches."""
+    header = header.strip()
+    return not header.startswith("W/") and not etag.startswith("W/") and header == etag
+
+
+def parse_byte_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    (start, end inclusive) of a single "bytes=" range, None for headers this ignores
+    (other units, multiple ranges, malformed). Raises ValueError if unsatisfiable.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        # suffix range: the last N bytes
+        if int(last) == 0 or size == 0:
+            raise ValueError("range not satisfiable")
+        return max(0, size - int(last)), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if last and end < start:
+        return None
+    if start >= size:
+        raise ValueError("range not satisfiable")
+    return start, min(end, size - 1)
+
+
+def cacheable_response(
+    request: Optional[Request],
+    data: bytes,
+    media_type: str,
+    cache_control: str,
+    headers: Optional[Dict[str, str]] = None,
+) -> Response:
+    """200 / 206 / 304 / 416 response for data, according to the request's conditional and Range headers."""
+    etag = content_etag(data)
+    out = {"ETag": etag, "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+    out.update(headers or {})
+    if request is None:
+        return Response(content=data, media_type=media_type, headers=out)
+
+    inm = request.headers.get("if-none-match")
+    if inm and _etag_matches(inm, etag):
+        return Response(status_code=304, headers=out)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or _if_range_matches(if_range, etag)):
+        try:
+            byte_range = parse_byte_range(range_header, len(data))
+        except ValueError:
+            out["Content-Range"] = f"bytes */{len(data)}"
+            return Response(status_code=416, headers=out)
+        if byte_range is not None:
+            start, end = byte_range
+            out["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            return Response(content=data[start:end + 1], status_code=206, media_type=media_type, headers=out)
+    return Response(content=data, media_type=media_type, headers=out)
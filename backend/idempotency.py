@@ -0,0 +1,75 @@
+"""
+Idempotency-Key support for endpoints that mobile clients retry.
+
+The first request for a key runs the handler; its response is kept in a bounded
+cache and replayed for later requests with the same key. Requests that arrive
+while the first one is still running wait for it instead of running again.
+"""
+import copy
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from .cache_utils import TTLCache, MISSING
+
+
+class IdempotencyCache:
+    def __init__(self, max_entries: int = 2048, ttl_seconds: float = 24 * 3600):
+        self._results = TTLCache(max_entries, ttl_seconds)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.replayed = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def _storable(result: Any) -> bool:
+        # handlers report some failures as {"error": ...} bodies; let those be retried
+        return not (isinstance(result, dict) and "error" in result)
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Run fn once per key. Returns (result, replayed).
+        Exceptions are propagated to concurrent waiters but never cached.
+        """
+        stored = self._results.get(key)
+        if stored is not MISSING:
+            self.replayed += 1
+            return copy.deepcopy(stored), True
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            result = await asyncio.shield(pending)
+            return copy.deepcopy(result), True
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        # the handler runs in its own task so a disconnecting leader doesn't cancel it
+        # for the requests waiting on the same key
+        leader = asyncio.ensure_future(self._lead(key, fn, fut))
+        leader.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return await asyncio.shield(leader), False
+
+    async def _lead(self, key: Hashable, fn: Callable[[], Awaitable[Any]], fut: asyncio.Future) -> Any:
+        try:
+            result = await fn()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                fut.cancel()
+            else:
+                fut.set_exception(e)
+                # mark retrieved so an unawaited future doesn't log a warning
+                fut.exception()
+            raise
+        else:
+            # snapshot: the handler may return live session state
+            snapshot = copy.deepcopy(result)
+            if self._storable(result):
+                self._results.set(key, snapshot)
+            fut.set_result(snapshot)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        out = self._results.stats()
+        out.update({"in_flight": len(self._inflight), "replayed": self.replayed, "coalesced": self.coalesced})
+        return out
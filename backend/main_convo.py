@@ -147,3 +147,22 @@ def get_error_message():
 def get_timeout(context="standard"):
     """Get the appropriate timeout for the given context."""
     return TIMEOUTS.get(context, TIMEOUTS["standard"])
+
+def get_static_prompts():
+    """
+    Every fixed sentence the voice flow can speak (no user data in it), in flow order
+    and without duplicates. Used to pre-synthesise prompt audio.
+    """
+    texts = [get_initial_prompt()]
+    texts += [v for k, v in CONVERSATION_CONFIG.items() if k != "clarification_prefix"]
+    for step in CLAIM_STATUS_FLOW.values():
+        texts += [v for k, v in step.items() if k.endswith("prompt") or k.endswith("completion")]
+    for field in CLAIM_FIELDS:
+        for name in (field, field.replace("_", " ")):
+            texts.append(get_field_prompt(name, True))
+            texts.append(get_field_prompt(name, False))
+    for name in EXAMPLE_PROMPTS:
+        texts.append(get_field_prompt(name, False))
+    texts += list(FIELD_PROMPTS.values())
+    seen = set()
+    return [t for t in texts if t and not (t in seen or seen.add(t))]
@@ -6,24 +6,31 @@ import io
 import sys
 import json
 import math
+import time
 import uuid
 import wave
+import asyncio
+import base64
 import hashlib
 import traceback
 import tempfile
 import datetime
+import threading
 import subprocess
 import mimetypes
 import shutil
 import platform
+import urllib.parse
 from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional, List, Any, Tuple
 
 import requests
+import httpx
 import fastapi
 import pydantic
-from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Request, Form
-from fastapi.responses import StreamingResponse, JSONResponse, RedirectResponse, FileResponse
+from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Request, Form, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, JSONResponse, RedirectResponse, FileResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
@@ -565,10 +572,29 @@ def health():
             "eleven_voice_configured": bool(ELEVEN_VOICE_ID),
             "eleven_api_key_length": len(ELEVEN_API_KEY) if ELEVEN_API_KEY else 0,
             "eleven_voice_id_length": len(ELEVEN_VOICE_ID) if ELEVEN_VOICE_ID else 0,
+            "stt_backend": _stt.name,
             "zoho_enabled": ZOHO_ENABLED,
             "frontend_url": FRONTEND_URL,
             "backend_url": BACKEND_URL
-        }
+        },
+        "tts_warm": TTS_PREWARM_STATE["state"] == "warm",
+    }
+
+@app.get("/metrics")
+def metrics():
+    """Internal counters (JSON) for the audio / caching paths."""
+    return {
+        "stt_audio": STT_AUDIO_STATS,
+        "vad": VAD_STATS,
+        "audio_gate": QUALITY_GATE_STATS,
+        "stt_cache": _stt_cache.stats(),
+        "stt": _stt.stats(),
+        "tts_cache": TTS_CACHE.stats(),
+        "tts_disk_cache": _tts_disk.stats() if _tts_disk is not None else None,
+        "tts_prewarm": TTS_PREWARM_STATE,
+        "tts_stream": dict(TTS_STREAM_STATS, in_flight=len(_tts_fills)),
+        "tts_templates": TEMPLATE_STATS,
+        "tts_variants": _tts_transcoder.stats() if _tts_transcoder is not None else None,
     }
 
 @app.get("/debug-env")
@@ -585,94 +611,515 @@ def debug_env():
         }
     }
 
-def _maybe_transcode_to_wav(src_path):
+from .cache_utils import TTLCache, ByteBudgetLRU, MISSING
+from .tts_disk_cache import DiskAudioCache, tts_cache_key
+from .audio_splice import splice_audio
+from .http_cache import cacheable_response
+from .tts_variants import negotiate, format_media_type, TranscodePool
+from .stt_service import create_stt_backend, STTError, CircuitOpenError, CircuitBreaker, ResilientSTT
+from .audio_pipeline import (
+    transcode_to_wav_stream, iter_bytes, TranscodeError,
+    sniff_audio_format, format_allowed, media_for_format, SpeechTrimmer,
+    AudioQualityError, metered_wav_stream, quality_problem, wav_levels,
+)
+
+# Shared async HTTP client for upstream calls made from async handlers (keep-alive pooled)
+STT_TIMEOUT_SECONDS = float(os.getenv("STT_TIMEOUT_SECONDS", "30"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+_http_client: Optional[httpx.AsyncClient] = None
+
+def _get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(STT_TIMEOUT_SECONDS, connect=10.0),
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+        )
+    return _http_client
+
+@app.on_event("shutdown")
+async def _shutdown_http_client() -> None:
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+# Formats forwarded to STT untouched (container, or container/codec e.g. "webm/opus").
+# Anything else is transcoded to 16k mono WAV first.
+STT_PASSTHROUGH_FORMATS = {
+    f.strip().lower() for f in os.getenv("STT_PASSTHROUGH_FORMATS", "wav,flac,mp3,ogg,webm,mp4").split(",") if f.strip()
+}
+# how often each audio preparation path is taken, by sniffed format
+STT_AUDIO_STATS: Dict[str, Dict[str, int]] = {"passthrough": {}, "transcoded": {}, "transcode_failed": {}}
+
+def _count_audio_path(path: str, fmt: Optional[str]) -> None:
+    bucket = STT_AUDIO_STATS[path]
+    key = fmt or "unknown"
+    bucket[key] = bucket.get(key, 0) + 1
+
+# Voice activity detection before STT: leading/trailing silence is trimmed (STT is
+# billed by audio duration) and recordings without speech never reach ElevenLabs.
+# Needs decoded PCM: it runs on PCM WAV uploads and on transcoded formats; other
+# STT_PASSTHROUGH_FORMATS uploads are never sent through ffmpeg just for VAD.
+STT_VAD = os.getenv("STT_VAD", "1").lower() not in ("0", "false", "no", "off")
+STT_VAD_THRESHOLD_DBFS = float(os.getenv("STT_VAD_THRESHOLD_DBFS", "-45"))
+STT_VAD_PAD_MS = int(os.getenv("STT_VAD_PAD_MS", "250"))
+STT_VAD_ONSET_MS = int(os.getenv("STT_VAD_ONSET_MS", "90"))
+VAD_STATS: Dict[str, int] = {"checked": 0, "no_speech": 0, "input_ms": 0, "sent_ms": 0, "trimmed_ms": 0}
+
+# Quality gate on the PCM: recordings that are too short, silent (dead mic) or heavily
+# clipped get a re-prompt straight away instead of a paid STT call returning "". PCM WAV
+# uploads are checked in memory before any upstream call; transcoded audio is checked as
+# ffmpeg's output streams through. Other STT_PASSTHROUGH_FORMATS are forwarded unchecked.
+STT_QUALITY_GATE = os.getenv("STT_QUALITY_GATE", "1").lower() not in ("0", "false", "no", "off")
+STT_GATE_MIN_DURATION_MS = int(os.getenv("STT_GATE_MIN_DURATION_MS", "300"))
+STT_GATE_MIN_PEAK_DBFS = float(os.getenv("STT_GATE_MIN_PEAK_DBFS", "-50"))
+STT_GATE_MAX_CLIPPED_RATIO = float(os.getenv("STT_GATE_MAX_CLIPPED_RATIO", "0.05"))
+QUALITY_GATE_STATS: Dict[str, Any] = {"checked": 0, "rejected": {}}
+
+REPEAT_HINT = "I didn't catch that — could you repeat your response? You also can use the text bar."
+
+AUDIO_REJECT_HINTS = {
+    "too_short": "That recording was too short — could you say it again? You also can use the text bar.",
+    "silent": "I couldn't hear anything — please check your microphone and try again. You also can use the text bar.",
+    "clipped": "The recording was too loud to understand — please hold the microphone a little further away and try again. You also can use the text bar.",
+    "stt_unavailable": "Voice input is having trouble right now — please use the text bar to type your answer.",
+}
+
+def _gate_check(levels: Optional[Dict[str, float]]) -> None:
+    """Raise AudioQualityError if the levels fail the gate (None: not meterable, let it through)."""
+    if levels is None:
+        return
+    QUALITY_GATE_STATS["checked"] += 1
+    reason = quality_problem(levels, STT_GATE_MIN_DURATION_MS / 1000.0, STT_GATE_MIN_PEAK_DBFS, STT_GATE_MAX_CLIPPED_RATIO)
+    if reason:
+        rejected = QUALITY_GATE_STATS["rejected"]
+        rejected[reason] = rejected.get(reason, 0) + 1
+        print(f"[audio-gate] rejected ({reason}): {levels}")
+        raise AudioQualityError(reason, levels)
+
+def _quality_gate(source):
     """
-    If src_path is not WAV, try to transcode to WAV using ffmpeg.
-    Returns path_to_send (may be src_path if no transcode), and a flag whether we should remove it after send.
+    Meter transcoded WAV as it streams through. Once it ends, a recording that fails the
+    gate raises AudioQualityError from the stream before its last chunk is released.
     """
-    ext = os.path.splitext(src_path)[1].lower()
-    if ext in ('.wav', '.pcm'):
-        return src_path, False
-    # preferred output WAV path
-    out = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-    out_path = out.name
-    out.close()
+    return metered_wav_stream(source, _gate_check)
+
+async def _speech_only(source):
+    """Wrap a WAV stream in a SpeechTrimmer and read ahead to the speech (check has_speech)."""
+    trimmer = SpeechTrimmer(source, STT_VAD_THRESHOLD_DBFS, STT_VAD_PAD_MS, STT_VAD_ONSET_MS)
     try:
-        # Use ffmpeg to convert to 16k mono WAV (ElevenLabs likes WAV)
-        subprocess.run([
-            'ffmpeg', '-y', '-i', src_path,
-            '-ar', '16000', '-ac', '1', out_path
-        ], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return out_path, True
-    except Exception as e:
-        # ffmpeg not available or conversion failed; fall back to original file
-        try:
-            if os.path.exists(out_path):
-                os.unlink(out_path)
-        except Exception:
-            pass
-        print("Warning: ffmpeg transcode failed or not available:", e)
-        return src_path, False
+        speech = await trimmer.start()
+    except AudioQualityError:
+        await trimmer.aclose()
+        raise
+    if not speech:
+        await trimmer.aclose()
+    return trimmer
+
+def _record_vad(vad_report: Dict[str, int], speech: bool, report: Optional[Dict[str, Any]]) -> None:
+    VAD_STATS["checked"] += 1
+    if not speech:
+        VAD_STATS["no_speech"] += 1
+    for k in ("input_ms", "sent_ms", "trimmed_ms"):
+        VAD_STATS[k] += vad_report[k]
+    if report is not None:
+        report.update(vad_report, speech=speech)
+
+async def _transcode_for_stt(data: bytes, filename: str):
+    """
+    Prepare uploaded audio for STT without touching disk.
+    Returns (chunk stream, filename, content type). Formats in STT_PASSTHROUGH_FORMATS
+    (sniffed from the bytes, not the file name) are sent as-is; anything else is piped
+    through ffmpeg and its WAV output streamed, falling back to the original bytes.
+    With STT_QUALITY_GATE a PCM WAV upload that fails the gate raises AudioQualityError
+    here, before anything is sent; transcoded audio is metered on its way through (the
+    stream, or the VAD read-ahead here, raises it at its end). With STT_VAD PCM WAV and
+    transcoded audio is trimmed to the speech (a SpeechTrimmer; check has_speech).
+    """
+    fmt = sniff_audio_format(data)
+    base = os.path.splitext(os.path.basename(filename))[0] or "audio"
+    if STT_QUALITY_GATE and fmt == "wav/pcm":
+        _gate_check(wav_levels(data))
+    if format_allowed(fmt, STT_PASSTHROUGH_FORMATS):
+        _count_audio_path("passthrough", fmt)
+        if STT_VAD and fmt == "wav/pcm":
+            return await _speech_only(iter_bytes(data)), base + ".wav", "audio/wav"
+        ext, ctype = media_for_format(fmt)
+        return iter_bytes(data), base + ext, ctype
+    stream = await transcode_to_wav_stream(data)
+    if stream is not None:
+        _count_audio_path("transcoded", fmt)
+        if STT_QUALITY_GATE and fmt != "wav/pcm":
+            stream = _quality_gate(stream)
+        if STT_VAD:
+            stream = await _speech_only(stream)
+        return stream, base + ".wav", "audio/wav"
+    _count_audio_path("transcode_failed", fmt)
+    ctype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    return iter_bytes(data), os.path.basename(filename), ctype
+
+# One STT backend for every endpoint: "elevenlabs" (default) or "mock" for offline load
+# tests (deterministic transcripts, STT_MOCK_LATENCY_MS +- STT_MOCK_JITTER_MS per call).
+STT_BACKEND = os.getenv("STT_BACKEND", "elevenlabs")
+_stt_backend = create_stt_backend(
+    STT_BACKEND,
+    api_key=ELEVEN_API_KEY,
+    model=ELEVEN_STT_MODEL,
+    get_client=_get_http_client,
+    latency_ms=float(os.getenv("STT_MOCK_LATENCY_MS", "0")),
+    jitter_ms=float(os.getenv("STT_MOCK_JITTER_MS", "0")),
+    text=os.getenv("STT_MOCK_TEXT") or None,
+)
+
+# Tail latency / outage handling: a hedged duplicate request is sent once the first is
+# slower than the STT_HEDGE_PERCENTILE of recent latencies, and the circuit breaker turns
+# voice turns into a "please use the text bar" prompt while upstream keeps failing.
+_stt = ResilientSTT(
+    _stt_backend,
+    CircuitBreaker(
+        failure_ratio=float(os.getenv("STT_BREAKER_FAILURE_RATIO", "0.5")),
+        window=int(os.getenv("STT_BREAKER_WINDOW", "20")),
+        min_calls=int(os.getenv("STT_BREAKER_MIN_CALLS", "5")),
+        open_seconds=float(os.getenv("STT_BREAKER_OPEN_SECONDS", "30")),
+    ),
+    hedge=os.getenv("STT_HEDGE", "1").lower() not in ("0", "false", "no", "off"),
+    hedge_percentile=float(os.getenv("STT_HEDGE_PERCENTILE", "95")),
+    min_delay_ms=float(os.getenv("STT_HEDGE_MIN_DELAY_MS", "500")),
+    initial_delay_ms=float(os.getenv("STT_HEDGE_INITIAL_DELAY_MS", "3000")),
+)
+print(f"[stt] backend: {_stt.name} (model {_stt.model_id}, hedging {'on' if _stt.hedge else 'off'})")
+
+async def _stt_transcribe(chunks, filename: str, content_type: str) -> str:
+    """
+    Transcribe an audio chunk stream with the configured backend.
+    Raises HTTPException(502) on upstream errors, CircuitOpenError while the breaker
+    is open; always closes chunks.
+    """
+    try:
+        return await _stt.transcribe(chunks, filename, content_type)
+    except CircuitOpenError:
+        raise
+    except STTError as e:
+        raise HTTPException(status_code=502, detail={"eleven_error": e.detail, "status": e.status})
+    finally:
+        await chunks.aclose()
+
+# Transcripts by audio content: retried uploads and replayed QA recordings skip the
+# decode and the paid STT call. Keyed by model too, so switching models never serves
+# stale text. Only non-empty upstream transcripts are stored.
+STT_CACHE_SIZE = int(os.getenv("STT_CACHE_SIZE", "1024"))
+STT_CACHE_TTL_SECONDS = float(os.getenv("STT_CACHE_TTL_SECONDS", "3600"))
+_stt_cache = TTLCache(STT_CACHE_SIZE, STT_CACHE_TTL_SECONDS)
+
+def _stt_cache_key(data: bytes) -> Tuple[str, str]:
+    return _stt.model_id, hashlib.blake2b(data, digest_size=16).hexdigest()
+
+async def _transcribe_bytes(data: bytes, filename: str, report: Optional[Dict[str, Any]] = None,
+                            use_cache: bool = True) -> str:
+    """
+    Transcode in memory if needed and transcribe audio bytes. Returns "" without calling
+    STT when the quality gate rejects the audio or VAD finds no speech. report, if given,
+    receives the VAD trim figures or the rejection reason and levels. use_cache=False
+    neither reads nor fills the transcript cache (streaming partials never repeat).
+    """
+    cache_key = _stt_cache_key(data) if use_cache else None
+    cached = _stt_cache.get(cache_key) if use_cache else MISSING
+    if cached is not MISSING:
+        if report is not None:
+            report["cached"] = True
+        return cached
+    if _stt.breaker.state == "open":
+        # fail fast, don't even decode
+        _stt.breaker.reject()
+        if report is not None:
+            report["rejected"] = "stt_unavailable"
+        return ""
+    try:
+        chunks, send_name, ctype = await _transcode_for_stt(data, filename)
+    except AudioQualityError as e:
+        if report is not None:
+            report.update(e.levels, rejected=e.reason)
+        return ""
+    except TranscodeError as e:
+        print("Audio decode error:", e)
+        raise HTTPException(status_code=502, detail={"eleven_error": str(e), "status": None})
+    trimmer = chunks if isinstance(chunks, SpeechTrimmer) else None
+    if trimmer is not None and not trimmer.has_speech:
+        _record_vad(trimmer.report(), False, report)
+        return ""
+    try:
+        text = await _stt_transcribe(chunks, send_name, ctype)
+    except CircuitOpenError:
+        if report is not None:
+            report["rejected"] = "stt_unavailable"
+        return ""
+    except AudioQualityError as e:
+        # gate verdict on transcoded audio reached at the end of the stream, the upload was abandoned
+        if report is not None:
+            report.update(e.levels, rejected=e.reason)
+        return ""
+    if trimmer is not None:
+        _record_vad(trimmer.report(), True, report)
+    if text and use_cache:
+        _stt_cache.set(cache_key, text)
+    return text
+
+# Raw audio bodies (Content-Type application/octet-stream or audio/*) skip multipart
+# parsing and the spooled temp file: the body is collected straight from the ASGI
+# stream into one buffer and handed to the transcode/STT stage.
+RAW_AUDIO_MAX_BYTES = int(os.getenv("RAW_AUDIO_MAX_BYTES", str(10 * 1024 * 1024)))
+
+def _is_raw_audio_request(request: Request) -> bool:
+    ctype = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    return ctype == "application/octet-stream" or ctype.startswith("audio/")
+
+async def _read_raw_audio(request: Request) -> Tuple[bytes, str]:
+    """Read a raw audio body. Returns (bytes, filename); raises HTTPException(413) past RAW_AUDIO_MAX_BYTES."""
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > RAW_AUDIO_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="audio body too large")
+    parts: List[bytes] = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > RAW_AUDIO_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="audio body too large")
+        parts.append(chunk)
+    ctype = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    filename = request.headers.get("X-Audio-Filename") or "turn" + (mimetypes.guess_extension(ctype) or ".bin")
+    return b"".join(parts), os.path.basename(filename)
+
+async def _transcribe_upload_async(file: UploadFile, report: Optional[Dict[str, Any]] = None) -> str:
+    """Read an uploaded audio file and transcribe it."""
+    data = await file.read()
+    filename = file.filename or "audio.wav"
+    if not os.path.splitext(filename)[1]:
+        filename += ".wav"
+    return await _transcribe_bytes(data, filename, report)
 
 # ---- patch /stt handler ----
 @app.post("/stt")
-def stt(file: UploadFile = File(...)):
+async def stt(file: UploadFile = File(...)):
     """
-    Accept multipart file, forward to ElevenLabs STT, return {"text": "..."}
+    Accept multipart file, transcribe with the configured STT backend, return {"text": "..."}
     """
-    if not ELEVEN_API_KEY:
+    if not _stt.configured:
         raise HTTPException(status_code=500, detail="ELEVEN_API_KEY not set")
+    report: Dict[str, Any] = {}
+    text = await _transcribe_upload_async(file, report)
+    if report.get("rejected") == "stt_unavailable":
+        raise HTTPException(status_code=503, detail="speech-to-text temporarily unavailable")
+    return {"text": text}
+
+
+# In-memory cache for TTS audio, bounded by total audio bytes (LRU). The first prompt and
+# the configured field prompts are pinned so arbitrary /tts text can't evict them.
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+def _tts_entry_size(entry: Any) -> int:
+    if isinstance(entry, tuple):
+        return len(entry[0])
+    if isinstance(entry, dict):
+        return len(entry.get("bytes") or b"")
+    return len(entry)
+
+TTS_CACHE = ByteBudgetLRU(TTS_CACHE_MAX_BYTES, size_of=_tts_entry_size)
+
+def _tts_cache_key(text: str) -> str:
+    return hashlib.md5(text.encode()).hexdigest()
+
+TTS_VOICE_SETTINGS = {"stability": 0.5, "similarity_boost": 0.75}
+
+# Persistent TTS audio under the memory cache, shared by workers on the same host and
+# kept across restarts ("" disables).
+TTS_DISK_CACHE_DIR = os.getenv("TTS_DISK_CACHE_DIR", os.path.join(os.path.dirname(__file__), "tts_cache"))
+TTS_DISK_CACHE_MAX_BYTES = int(os.getenv("TTS_DISK_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+_tts_disk = DiskAudioCache(TTS_DISK_CACHE_DIR, TTS_DISK_CACHE_MAX_BYTES) if TTS_DISK_CACHE_DIR else None
+
+def _tts_disk_key(text: str) -> str:
+    return tts_cache_key(text, ELEVEN_VOICE_ID or "", TTS_VOICE_SETTINGS)
+
+# HTTP caching of TTS audio. Cached audio is served with a content-hash ETag (304 on
+# If-None-Match), byte ranges, TTS_HTTP_MAX_AGE, and a Content-Location of /tts/audio/{key}:
+# the same audio by its synthesis key (text, voice, settings). That key names what was
+# asked for, not the bytes (a template prompt may be spliced on one worker and synthesised
+# whole on another), so it is not immutable; clients revalidate by ETag. /tts/audio/{key}
+# finds audio on the disk cache or, for texts this worker has seen, in memory; audio held
+# only in another worker's memory (spliced template prompts) is a 404 there.
+TTS_HTTP_MAX_AGE = int(os.getenv("TTS_HTTP_MAX_AGE", "86400"))
+TTS_CACHE_CONTROL = f"public, max-age={TTS_HTTP_MAX_AGE}"
+# synthesis key -> text, so /tts/audio/{key} can find audio that is only in memory
+_tts_audio_texts = TTLCache(int(os.getenv("TTS_AUDIO_KEYS", "4096")))
+
+def _tts_cached_audio(text: str) -> Optional[Tuple[bytes, str]]:
+    """text's audio from the memory cache or the disk cache (promoted to memory), without synthesising."""
+    text_hash = _tts_cache_key(text)
+    cached = _tts_memory_hit(text_hash)
+    if cached is None and _tts_disk is not None:
+        cached = _tts_disk.read(_tts_disk_key(text))
+        if cached is not None:
+            TTS_CACHE[text_hash] = cached
+    return cached
+
+# Accept-negotiated Opus variants (audio/webm, audio/ogg) of cached TTS audio. Each variant
+# is transcoded once per source clip on a background pool and cached in memory and on
+# disk; until it exists the source format is served with Cache-Control: no-cache, so the
+# variant replaces it on the next revalidation. Browsers' <audio> elements send Accept: */*,
+# so clients can also opt in explicitly with ?format=webm (or ogg).
+TTS_VARIANTS = os.getenv("TTS_VARIANTS", "1").lower() not in ("0", "false", "no", "off")
+TTS_OPUS_BITRATE = os.getenv("TTS_OPUS_BITRATE", "32k")
+TTS_TRANSCODE_WORKERS = int(os.getenv("TTS_TRANSCODE_WORKERS", "2"))
+
+def _tts_variant_key(key: str, media_type: str) -> str:
+    return hashlib.sha256(f"{key}:{media_type}".encode()).hexdigest()
+
+def _store_tts_variant(key: str, media_type: str, data: bytes) -> None:
+    variant_key = _tts_variant_key(key, media_type)
+    TTS_CACHE[variant_key] = (data, media_type)
+    if _tts_disk is not None:
+        _tts_disk.put(variant_key, data, media_type)
+
+_tts_transcoder = TranscodePool(_store_tts_variant, TTS_TRANSCODE_WORKERS, TTS_OPUS_BITRATE) if TTS_VARIANTS else None
+
+def _negotiate_tts_audio(request: Optional[Request], key: str, audio_bytes: bytes,
+                         media_type: str) -> Tuple[bytes, str, bool]:
+    """
+    The variant of the audio under synthesis key `key` that the request asks for (?format=,
+    else Accept), if it exists yet. The flag is True when the source stands in for a
+    variant that is still being transcoded.
+    """
+    if _tts_transcoder is None or request is None:
+        return audio_bytes, media_type, False
+    target = format_media_type(request.query_params.get("format")) or negotiate(request.headers.get("accept"), media_type)
+    if target == media_type:
+        return audio_bytes, media_type, False
+    variant_key = _tts_variant_key(key, target)
+    variant = TTS_CACHE.get(variant_key)
+    if variant is None and _tts_disk is not None:
+        variant = _tts_disk.read(variant_key)
+        if variant is not None:
+            TTS_CACHE[variant_key] = variant
+    if variant is not None:
+        return variant[0], variant[1], False
+    _tts_transcoder.submit(key, audio_bytes, target)
+    return audio_bytes, media_type, True
+
+def _keyed_audio_response(request: Optional[Request], key: str, audio_bytes: bytes, media_type: str,
+                          cache_control: str) -> Response:
+    audio_bytes, media_type, pending = _negotiate_tts_audio(request, key, audio_bytes, media_type)
+    if pending:
+        cache_control = "no-cache"  # stand-in: revalidate, so the variant is picked up once ready
+    headers = {"Content-Location": f"/tts/audio/{key}"}
+    if _tts_transcoder is not None:
+        headers["Vary"] = "Accept"
+    return cacheable_response(request, audio_bytes, media_type, cache_control, headers=headers)
+
+def _tts_http_response(request: Optional[Request], text: str, audio_bytes: bytes, media_type: str,
+                       cache_control: str = TTS_CACHE_CONTROL) -> Response:
+    media_type = media_type or "application/octet-stream"
+    if audio_bytes == _make_dummy_mp3():
+        # placeholder after an upstream failure: never let anything cache it
+        return Response(content=audio_bytes, media_type=media_type, headers={"Cache-Control": "no-store"})
+    key = _tts_disk_key(text)
+    _tts_audio_texts.set(key, text)
+    return _keyed_audio_response(request, key, audio_bytes, media_type, cache_control)
+
+def _tts_audio_response(text: str, request: Optional[Request] = None, strict: bool = False,
+                        cache_control: str = TTS_CACHE_CONTROL):
+    """
+    Synthesized audio for text: cached audio (with HTTP caching headers) when there is
+    some, else the live ElevenLabs stream, teed into the caches (see _TTSFill).
+    strict=False answers upstream failures with cached_tts' fallback audio;
+    strict=True raises HTTPException.
+    """
+    cached = _tts_cached_audio(text)
+    if cached is None:
+        # assembled from cached fragments, no upstream stream needed; if that fails the
+        # whole text is streamed below, so strict applies to templates too
+        cached = _template_audio(text)
+    if cached is None:
+        try:
+            fill = _tts_fill(text)
+        except HTTPException:
+            if strict:
+                raise
+            cached = cached_tts(text, check_disk=False)
+        else:
+            # no Content-Length: a joined or failed upstream stream may not deliver it
+            return StreamingResponse(fill.listen(), media_type=fill.media_type)
+    return _tts_http_response(request, text, cached[0], cached[1], cache_control)
+
+# Prompt templates: dynamic prompts that differ only in a slot are assembled from separately
+# cached fragments (the literal text and the slot values) spliced at frame boundaries,
+# instead of synthesising every variant. {slot} matches any text.
+TTS_PROMPT_TEMPLATES = os.getenv("TTS_PROMPT_TEMPLATES", "1").lower() not in ("0", "false", "no", "off")
+PROMPT_TEMPLATES = [
+    "{hint} (I'm asking for: {field})",
+    "Sorry, I didn't catch that. {example} You also can use the text bar.",
+]
+TEMPLATE_STATS = {"spliced": 0, "fallback": 0}
 
-    suffix = os.path.splitext(file.filename)[1] or ".wav"
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-        shutil.copyfileobj(file.file, tmp)
-        tmp_path = tmp.name
+def _compile_prompt_template(template: str):
+    parts = re.split(r"\{(\w+)\}", template)  # literal, slot, literal, ...
+    pattern = "".join(re.escape(p) if i % 2 == 0 else "(.+?)" for i, p in enumerate(parts))
+    return re.compile(pattern), parts
 
-    send_path = tmp_path
-    remove_send = False
-    try:
-        # try transcode if needed (webm/ogg/mp4/m4a etc.)
-        send_path, remove_send = _maybe_transcode_to_wav(tmp_path)
-
-        url = "https://api.elevenlabs.io/v1/speech-to-text"
-        headers = {"xi-api-key": ELEVEN_API_KEY, "Accept": "application/json"}
-        with open(send_path, "rb") as fh:
-            # set content-type according to file ext
-            ctype = mimetypes.guess_type(send_path)[0] or "application/octet-stream"
-            files = {"file": (os.path.basename(send_path), fh, ctype)}
-            data = {"model_id": ELEVEN_STT_MODEL}
-            resp = requests.post(url, headers=headers, files=files, data=data, timeout=30)
-
-        if resp.status_code >= 400:
-            # log body for debugging
-            print("ElevenLabs STT error:", resp.status_code, resp.text)
-            raise HTTPException(status_code=502, detail={"eleven_error": resp.text, "status": resp.status_code})
-
-        body = resp.json()
-        text = (
-            body.get("text")
-            or body.get("transcript")
-            or body.get("transcription")
-            or (body.get("results") and body["results"][0].get("text"))
-            or ""
-        )
-        return {"text": text.strip()}
-    finally:
-        # cleanup temps
-        try:
-            if os.path.exists(tmp_path):
-                os.unlink(tmp_path)
-        except Exception:
-            pass
-        try:
-            if remove_send and send_path and os.path.exists(send_path):
-                os.unlink(send_path)
-        except Exception:
-            pass
+_PROMPT_TEMPLATE_RES = [_compile_prompt_template(t) for t in PROMPT_TEMPLATES]
 
+def prompt_fragments(text: str) -> Optional[List[str]]:
+    """Fragments to synthesise separately if text matches a prompt template, else None."""
+    if not TTS_PROMPT_TEMPLATES:
+        return None
+    for regex, parts in _PROMPT_TEMPLATE_RES:
+        m = regex.fullmatch(text)
+        if not m:
+            continue
+        fragments = []
+        for i, part in enumerate(parts):
+            piece = part.strip(" ()") if i % 2 == 0 else m.group(i // 2 + 1).strip()
+            if piece:
+                fragments.append(piece)
+        return fragments
+    return None
 
-# Simple in-memory cache for TTS audio
-TTS_CACHE = {}
+def _template_fragment_texts() -> List[str]:
+    """Every literal fragment and known slot value of PROMPT_TEMPLATES (for prewarming)."""
+    texts = []
+    for _, parts in _PROMPT_TEMPLATE_RES:
+        texts += [p.strip(" ()") for p in parts[0::2] if p.strip(" ()")]
+    texts += [REPEAT_HINT] + list(AUDIO_REJECT_HINTS.values())
+    texts += list(CLAIM_FIELDS)
+    texts += list((getattr(main_convo, "EXAMPLE_PROMPTS", None) or {}).values()) if main_convo else []
+    return texts
+
+def _template_audio(text: str) -> Optional[Tuple[bytes, str]]:
+    """Spliced audio for a template prompt (cached in memory only: it is rebuilt from the fragments' disk entries for free)."""
+    fragments = prompt_fragments(text)
+    if not fragments:
+        return None
+    spliced = _splice_prompt_audio(fragments)
+    if spliced is not None:
+        TTS_CACHE[_tts_cache_key(text)] = spliced
+    return spliced
+
+def _splice_prompt_audio(fragments: List[str]) -> Optional[Tuple[bytes, str]]:
+    """Template prompt audio from cached fragment audio, or None if it can't be spliced."""
+    parts = []
+    for fragment in fragments:
+        audio_bytes, media_type = cached_tts(fragment)
+        if audio_bytes == _make_dummy_mp3():
+            return None  # fragment synthesis failed: don't build a prompt around placeholder audio
+        parts.append((audio_bytes, media_type))
+    media_types = {media for _, media in parts}
+    joined = splice_audio([a for a, _ in parts], media_types.pop()) if len(media_types) == 1 else None
+    if joined is None:
+        print(f"[tts-template] fragments can't be spliced ({len(parts)} parts, {media_types or 'mixed'})")
+        TEMPLATE_STATS["fallback"] += 1
+        return None
+    TEMPLATE_STATS["spliced"] += 1
+    return joined, parts[0][1]
 
 def _make_dummy_mp3():
     # Minimal MP3-like header + silence padding for fallback
@@ -692,79 +1139,24 @@ def _detect_media_type_from_bytes(b: bytes) -> str:
     return "application/octet-stream"
 
 
-def cached_tts(text: str) -> tuple[bytes, str]:
+def cached_tts(text: str, check_disk: bool = True) -> tuple[bytes, str]:
     """
-    TTS with simple caching. Returns (audio bytes, media_type).
-    Cache key is MD5 hash of text.
+    TTS with caching: memory (TTS_CACHE, key MD5 of text), then the disk cache, then
+    ElevenLabs. Returns (audio bytes, media_type). check_disk=False skips the disk
+    lookup when the caller just did it. Concurrent misses for the same text share one
+    upstream stream (_tts_fills) instead of calling ElevenLabs again.
     """
     print(f"[cached_tts] Starting TTS for text: {text[:50]}...")  # Debug logging
     try:
         # Create cache key
-        text_hash = hashlib.md5(text.encode()).hexdigest()
+        text_hash = _tts_cache_key(text)
         print(f"[cached_tts] Text hash: {text_hash}")  # Debug logging
 
         # Check cache first
-        if text_hash in TTS_CACHE:
-            cached = TTS_CACHE[text_hash]
-            if isinstance(cached, tuple) and len(cached) == 2:
-                print(f"[cached_tts] Cache hit (tuple)! Returning cached audio")
-                return cached
-            media = _detect_media_type_from_bytes(cached)
-            print(f"[cached_tts] Cache hit (legacy bytes). Detected media: {media}")
-            return cached, media
-
-        # Check environment variables
-        print(f"[cached_tts] Checking env vars - API Key: {bool(ELEVEN_API_KEY)}, Voice ID: {bool(ELEVEN_VOICE_ID)}")
-        if not ELEVEN_API_KEY or not ELEVEN_VOICE_ID:
-            print(f"[cached_tts] Missing env vars - API Key: {bool(ELEVEN_API_KEY)}, Voice ID: {bool(ELEVEN_VOICE_ID)}")
-            # Return dummy audio instead of failing
-            dummy_audio = _make_dummy_mp3()
-            print(f"[cached_tts] Returning dummy audio due to missing env vars")
-            return dummy_audio, "audio/mpeg"
-
-        print(f"[cached_tts] Making API call to ElevenLabs...")  # Debug logging
-        print(f"[cached_tts] Voice ID: {ELEVEN_VOICE_ID}")  # Debug logging
-        print(f"[cached_tts] API Key length: {len(ELEVEN_API_KEY)}")  # Debug logging
-
-        # Make API call to ElevenLabs
-        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVEN_VOICE_ID}/stream"
-        headers = {
-            "xi-api-key": ELEVEN_API_KEY,
-            "Accept": "audio/mpeg, audio/wav, */*",
-            "Content-Type": "application/json",
-        }
-        body = {"text": text, "voice_settings": {"stability": 0.5, "similarity_boost": 0.75}}
-
-        print(f"[cached_tts] Making request to: {url}")  # Debug logging
-        resp = requests.post(url, headers=headers, json=body, timeout=30)
-
-        print(f"[cached_tts] ElevenLabs response: {resp.status_code}")  # Debug logging
-        try:
-            print(f"[cached_tts] ElevenLabs Content-Type: {resp.headers.get('Content-Type')}")
-            preview = resp.content[:64]
-            print(f"[cached_tts] ElevenLabs resp.content preview (hex len={len(resp.content)}): {preview.hex()}")
-        except Exception as _e:
-            print(f"[cached_tts] Could not preview resp.content: {_e}")
-
-        if resp.status_code != 200:
-            print(f"[cached_tts] ElevenLabs error: {resp.status_code} {resp.text[:200]}")  # Debug logging
-            # Return dummy audio instead of failing completely
-            dummy_audio = _make_dummy_mp3()
-            print(f"[cached_tts] Returning dummy audio due to ElevenLabs error")
-            return dummy_audio, "audio/mpeg"
-
-        audio_bytes = resp.content
-        media_type = resp.headers.get("Content-Type") or _detect_media_type_from_bytes(audio_bytes)
-        # Normalize common content-type values
-        if media_type and ";" in media_type:
-            media_type = media_type.split(";")[0].strip()
-
-        print(f"[cached_tts] Received audio: {len(audio_bytes)} bytes, media_type={media_type}")  # Debug logging
-
-        # Cache the result as tuple
-        TTS_CACHE[text_hash] = (audio_bytes, media_type)
-
-        return audio_bytes, media_type
+        cached = _tts_memory_hit(text_hash)
+        if cached is not None:
+            return cached
+        return _tts_miss(text, text_hash, check_disk)
 
     except HTTPException:
         # Re-raise HTTPExceptions as-is
@@ -778,51 +1170,343 @@ def cached_tts(text: str) -> tuple[bytes, str]:
         print(f"[cached_tts] Returning dummy audio due to exception")
         return dummy_audio, "audio/mpeg"
 
-from fastapi import Body
-from fastapi import Query
-from starlette.responses import StreamingResponse
+# Template prompt misses block a thread on each fragment's synthesis in turn; they get a
+# bounded executor of their own so a burst of them can't exhaust the shared default one.
+TTS_TEMPLATE_WORKERS = int(os.getenv("TTS_TEMPLATE_WORKERS", "4"))
+_tts_template_executor = ThreadPoolExecutor(max_workers=max(1, TTS_TEMPLATE_WORKERS), thread_name_prefix="tts-template")
+
+async def cached_tts_async(text: str, check_disk: bool = True) -> tuple[bytes, str]:
+    """cached_tts for coroutines: misses run on a worker thread, sharing in-flight streams with cached_tts."""
+    text_hash = _tts_cache_key(text)
+    cached = _tts_memory_hit(text_hash)
+    if cached is not None:
+        return cached
+    executor = _tts_template_executor if prompt_fragments(text) else None
+    try:
+        # the upstream stream runs on its own reader thread, so a cancelled caller still fills the cache
+        return await asyncio.get_running_loop().run_in_executor(executor, _tts_miss, text, text_hash, check_disk)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"[cached_tts] Unexpected error: {str(e)}")
+        traceback.print_exc()
+        return _make_dummy_mp3(), "audio/mpeg"
 
-@app.get("/tts-stream")
-def tts_stream(text: str = Query(...)):
+def _tts_memory_hit(text_hash: str) -> Optional[tuple]:
+    cached = TTS_CACHE.get(text_hash)
+    if cached is None:
+        return None
+    if isinstance(cached, tuple) and len(cached) == 2:
+        print(f"[cached_tts] Cache hit (tuple)! Returning cached audio")
+        return cached
+    media = _detect_media_type_from_bytes(cached)
+    print(f"[cached_tts] Cache hit (legacy bytes). Detected media: {media}")
+    return cached, media
+
+def _tts_miss(text: str, text_hash: str, check_disk: bool) -> tuple[bytes, str]:
+    """Memory-cache miss: disk cache, template splice, or the (shared) ElevenLabs stream."""
+    # an in-flight stream for this key may have filled the cache just before this call
+    cached = _tts_memory_hit(text_hash)
+    if cached is not None:
+        return cached
+
+    if check_disk and _tts_disk is not None:
+        stored = _tts_disk.read(_tts_disk_key(text))
+        if stored is not None:
+            print(f"[cached_tts] Disk cache hit ({len(stored[0])} bytes)")
+            TTS_CACHE[text_hash] = stored
+            return stored
+
+    spliced = _template_audio(text)
+    if spliced is not None:
+        return spliced
+
+    # Check environment variables
+    print(f"[cached_tts] Checking env vars - API Key: {bool(ELEVEN_API_KEY)}, Voice ID: {bool(ELEVEN_VOICE_ID)}")
     if not ELEVEN_API_KEY or not ELEVEN_VOICE_ID:
-        raise HTTPException(status_code=500, detail="ElevenLabs not configured")
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVEN_VOICE_ID}/stream"
-    headers = {
-        "xi-api-key": ELEVEN_API_KEY,
-        "Accept": "audio/mpeg",
-        "Content-Type": "application/json",
-    }
-    body = {"text": text, "voice_settings": {"stability": 0.5, "similarity_boost": 0.75}}
+        print(f"[cached_tts] Missing env vars - API Key: {bool(ELEVEN_API_KEY)}, Voice ID: {bool(ELEVEN_VOICE_ID)}")
+        # Return dummy audio instead of failing
+        dummy_audio = _make_dummy_mp3()
+        print(f"[cached_tts] Returning dummy audio due to missing env vars")
+        return dummy_audio, "audio/mpeg"
 
+    # the same upstream stream /tts-stream listeners use: joined if one is in flight
     try:
-        r = requests.post(url, headers=headers, json=body, timeout=60, stream=True)
-    except Exception as e:
-        raise HTTPException(status_code=502, detail=f"ElevenLabs conn error: {e}")
-
-    if r.status_code != 200:
-        err_text = r.text[:300] if hasattr(r, "text") else str(r.status_code)
-        raise HTTPException(status_code=502, detail=f"ElevenLabs error: {err_text}")
+        fill = _tts_fill(text)
+    except HTTPException as he:
+        print(f"[cached_tts] ElevenLabs error: {he.detail}")
+        print(f"[cached_tts] Returning dummy audio due to ElevenLabs error")
+        return _make_dummy_mp3(), "audio/mpeg"
+    audio_bytes = fill.wait()
+    if not fill.completed:
+        print(f"[cached_tts] Returning dummy audio: upstream stream failed")
+        return _make_dummy_mp3(), "audio/mpeg"
+
+    print(f"[cached_tts] Received audio: {len(audio_bytes)} bytes, media_type={fill.media_type}")  # Debug logging
+    # the fill has cached it in memory and on disk
+    return audio_bytes, fill.media_type
 
-    media_type = r.headers.get("Content-Type", "audio/mpeg")
-    headers_out = {}
-    if "Content-Length" in r.headers:
-        headers_out["Content-Length"] = r.headers["Content-Length"]
+from fastapi import Body
+from fastapi import Query
+from starlette.responses import StreamingResponse
 
-    def gen():
+# Upstream TTS streams in flight, by TTS_CACHE key: the one registry of ElevenLabs calls
+# in progress. Streaming listeners and cached_tts misses for the same text share one
+# upstream request; the reader thread finishes the cache fill even if they all disconnect.
+_tts_fills: Dict[str, "_TTSFill"] = {}
+_tts_fills_lock = threading.Lock()
+TTS_STREAM_STATS = {"started": 0, "joined": 0, "completed": 0, "failed": 0}
+
+class _TTSFill:
+    def __init__(self, text: str):
+        self.text = text
+        self.key = _tts_cache_key(text)
+        self.media_type = "audio/mpeg"
+        self.error: Optional[HTTPException] = None
+        self._resp = None
+        self._chunks: List[bytes] = []
+        self._done = False
+        self.completed = False
+        self._started = threading.Event()
+        self._cond = threading.Condition()
+        # (loop, event) of each async listener, set from the reader thread on progress
+        self._listeners: set = set()
+
+    def start(self, resp) -> None:
+        self._resp = resp
+        self.media_type = (resp.headers.get("Content-Type") or "audio/mpeg").split(";")[0].strip()
+        threading.Thread(target=self._pump, name="tts-fill", daemon=True).start()
+        self._started.set()
+
+    def fail(self, error: HTTPException) -> None:
+        """The upstream request could not be started: release everyone waiting on it."""
+        self.error = error
+        TTS_STREAM_STATS["failed"] += 1
+        self._unregister()
+        with self._cond:
+            self._done = True
+            self._notify()
+        self._started.set()
+
+    def wait_started(self) -> None:
+        """Block until the upstream response has started (raises its HTTPException if it failed)."""
+        self._started.wait()
+        if self.error is not None:
+            raise self.error
+
+    def _unregister(self) -> None:
+        with _tts_fills_lock:
+            if _tts_fills.get(self.key) is self:
+                del _tts_fills[self.key]
+
+    def _pump(self) -> None:
+        error = None
         try:
-            for chunk in r.iter_content(chunk_size=16384):
+            for chunk in self._resp.iter_content(chunk_size=16384):
                 if chunk:
-                    yield chunk
+                    with self._cond:
+                        self._chunks.append(chunk)
+                        self._notify()
+        except Exception as e:
+            error = e
+            print(f"[tts-stream] upstream read failed for {self.key}: {e}")
         finally:
             try:
-                r.close()
+                self._resp.close()
             except Exception:
                 pass
+        audio = b"".join(self._chunks)
+        if error is None and audio:
+            TTS_CACHE[self.key] = (audio, self.media_type)
+            if _tts_disk is not None:
+                _tts_disk.put(_tts_disk_key(self.text), audio, self.media_type)
+            self.completed = True
+            TTS_STREAM_STATS["completed"] += 1
+        else:
+            TTS_STREAM_STATS["failed"] += 1
+        # unregister only after the cache is filled so later requests hit it
+        self._unregister()
+        with self._cond:
+            self._done = True
+            self._notify()
+
+    def _notify(self) -> None:
+        # called with self._cond held
+        self._cond.notify_all()
+        for loop, event in self._listeners:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass  # listener's loop already closed
+
+    async def listen(self):
+        """Chunks received so far, then live ones until the upstream stream ends (no thread held while waiting)."""
+        listener = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cond:
+            self._listeners.add(listener)
+        sent = 0
+        try:
+            while True:
+                listener[1].clear()
+                with self._cond:
+                    new = self._chunks[sent:]
+                    done = self._done
+                for chunk in new:
+                    yield chunk
+                sent += len(new)
+                if done:
+                    return
+                if not new:
+                    await listener[1].wait()
+        finally:
+            with self._cond:
+                self._listeners.discard(listener)
+
+    def wait(self) -> bytes:
+        """Block until the upstream stream ends; the audio received (complete if self.completed)."""
+        with self._cond:
+            while not self._done:
+                self._cond.wait()
+            return b"".join(self._chunks)
+
+def _tts_fill(text: str) -> _TTSFill:
+    """Join the in-flight upstream stream for text, or start one (HTTPException if that fails)."""
+    key = _tts_cache_key(text)
+    with _tts_fills_lock:
+        fill = _tts_fills.get(key)
+        leader = fill is None
+        if leader:
+            # registered before the request is sent, so concurrent callers never send a second one
+            fill = _tts_fills[key] = _TTSFill(text)
+    if not leader:
+        TTS_STREAM_STATS["joined"] += 1
+        fill.wait_started()
+        return fill
+
+    try:
+        if not ELEVEN_API_KEY or not ELEVEN_VOICE_ID:
+            raise HTTPException(status_code=500, detail="ElevenLabs not configured")
+        url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVEN_VOICE_ID}/stream"
+        headers = {
+            "xi-api-key": ELEVEN_API_KEY,
+            "Accept": "audio/mpeg",
+            "Content-Type": "application/json",
+        }
+        body = {"text": text, "voice_settings": TTS_VOICE_SETTINGS}
+
+        try:
+            r = requests.post(url, headers=headers, json=body, timeout=60, stream=True)
+        except Exception as e:
+            raise HTTPException(status_code=502, detail=f"ElevenLabs conn error: {e}")
+
+        if r.status_code != 200:
+            err_text = r.text[:300] if hasattr(r, "text") else str(r.status_code)
+            r.close()
+            raise HTTPException(status_code=502, detail=f"ElevenLabs error: {err_text}")
+    except HTTPException as he:
+        fill.fail(he)
+        raise
+
+    TTS_STREAM_STATS["started"] += 1
+    fill.start(r)
+    return fill
+
+# Sentence-chunked TTS (/tts-stream?chunked=1): the text is split at sentence boundaries,
+# the sentences are synthesised concurrently through cached_tts (each cached on its own)
+# and streamed in order, so audio starts once the first sentence is rendered. Only real
+# MP3 is concatenated: if the first sentence fails the whole text is streamed instead,
+# a later failure ends the response with an error rather than splicing in a placeholder.
+TTS_SENTENCE_CHUNKS = os.getenv("TTS_SENTENCE_CHUNKS", "1").lower() in ("1", "true", "yes", "on")
+TTS_CHUNK_CONCURRENCY = int(os.getenv("TTS_CHUNK_CONCURRENCY", "4"))
+TTS_CHUNK_MIN_CHARS = int(os.getenv("TTS_CHUNK_MIN_CHARS", "20"))
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+def split_sentences(text: str, min_chars: int = TTS_CHUNK_MIN_CHARS) -> List[str]:
+    """Sentences of text; pieces shorter than min_chars are merged into the following one."""
+    chunks: List[str] = []
+    pending = ""
+    for part in _SENTENCE_END.split(text.strip()):
+        pending = f"{pending} {part}" if pending else part
+        if len(pending) >= min_chars:
+            chunks.append(pending)
+            pending = ""
+    if pending:
+        if chunks:
+            chunks[-1] = f"{chunks[-1]} {pending}"
+        else:
+            chunks.append(pending)
+    return chunks
+
+async def _sentence_chunked_audio(text: str, sentences: List[str]):
+    sem = asyncio.Semaphore(max(1, TTS_CHUNK_CONCURRENCY))
+
+    async def render(sentence: str) -> Optional[bytes]:
+        async with sem:
+            audio_bytes, media_type = await cached_tts_async(sentence)
+        if media_type != "audio/mpeg" or audio_bytes == _make_dummy_mp3():
+            return None  # placeholder or a format whose clips can't be concatenated
+        return audio_bytes
+
+    # all sentences start rendering now (bounded), and are sent in order
+    tasks = [asyncio.ensure_future(render(t)) for t in sentences]
+    try:
+        for i, task in enumerate(tasks):
+            audio_bytes = await task
+            if audio_bytes is not None:
+                yield audio_bytes
+                continue
+            if i:
+                print(f"[tts-stream] sentence {i + 1}/{len(sentences)} failed, ending the chunked stream")
+                raise RuntimeError("sentence synthesis failed mid-stream")
+            print("[tts-stream] first sentence failed, streaming the whole text instead")
+            fill = await asyncio.to_thread(_tts_fill, text)
+            if fill.media_type != "audio/mpeg":
+                raise RuntimeError(f"whole-text fallback returned {fill.media_type}")
+            async for chunk in fill.listen():
+                yield chunk
+            if not fill.completed:
+                raise RuntimeError("whole-text fallback stream failed")
+            return
+    finally:
+        # client gone: sentences already at ElevenLabs still finish and get cached
+        for task in tasks:
+            task.cancel()
+
+@app.get("/tts-stream")
+def tts_stream(request: Request, text: str = Query(...), chunked: Optional[bool] = Query(None)):
+    """
+    Low time-to-first-byte TTS: cached audio, or the upstream stream while it fills the
+    cache. chunked=1 (default TTS_SENTENCE_CHUNKS) renders multi-sentence text per sentence.
+    """
+    if chunked is None:
+        chunked = TTS_SENTENCE_CHUNKS
+    # template prompts are assembled from cached fragments instead
+    sentences = split_sentences(text) if chunked and not prompt_fragments(text) else []
+    # cached, or already streaming from upstream (e.g. a turn's speculative synthesis): join that
+    if len(sentences) < 2 or _tts_cache_key(text) in _tts_fills or _tts_cached_audio(text) is not None:
+        return _tts_audio_response(text, request, strict=True)
+    if not ELEVEN_API_KEY or not ELEVEN_VOICE_ID:
+        raise HTTPException(status_code=500, detail="ElevenLabs not configured")
+    # /stream returns MP3, whose frames can simply be concatenated
+    return StreamingResponse(_sentence_chunked_audio(text, sentences), media_type="audio/mpeg")
+
+@app.get("/tts/audio/{key}")
+def tts_audio(key: str, request: Request):
+    """Synthesized audio by synthesis key (the Content-Location of the other TTS responses)."""
+    if not re.fullmatch(r"[0-9a-f]{64}", key):
+        raise HTTPException(status_code=404, detail="unknown audio key")
+    text = _tts_audio_texts.get(key)
+    if text is not MISSING:
+        # may still be synthesising (speculative turn audio): wait for that call
+        audio_bytes, media_type = cached_tts(text)
+        return _tts_http_response(request, text, audio_bytes, media_type)
+    cached = _tts_disk.read(key) if _tts_disk is not None else None
+    if cached is None:
+        raise HTTPException(status_code=404, detail="unknown audio key")
+    return _keyed_audio_response(request, key, cached[0], cached[1] or "application/octet-stream", TTS_CACHE_CONTROL)
 
-    return StreamingResponse(gen(), media_type=media_type, headers=headers_out)
-    
 @app.post("/tts")
-def tts(payload: Dict[str, Any] = Body(...)):
+def tts(request: Request, payload: Dict[str, Any] = Body(...)):
     """
     Text-to-speech endpoint supporting either:
       - {"text": "..."} to synthesize arbitrary text
@@ -850,9 +1534,7 @@ def tts(payload: Dict[str, Any] = Body(...)):
         if not text:
             raise HTTPException(status_code=400, detail="missing text or field")
 
-        audio_bytes, media_type = cached_tts(text)
-        headers = {"Content-Length": str(len(audio_bytes))}
-        return StreamingResponse(io.BytesIO(audio_bytes), media_type=media_type or "application/octet-stream", headers=headers)
+        return _tts_audio_response(text, request)
     except HTTPException:
         raise
     except Exception as e:
@@ -900,7 +1582,7 @@ def tts(payload: Dict[str, Any] = Body(...)):
 
 # convenience endpoint to synthesize an existing prompt by field name (GET)
 @app.get("/tts-prompt/{field}")
-def tts_prompt(field: str):
+def tts_prompt(field: str, request: Request):
     """
     Synthesize a prompt from main_convo.FIELD_PROMPTS by field key.
     Useful for quickly generating audio for the configured questions.
@@ -917,9 +1599,7 @@ def tts_prompt(field: str):
     if not text:
         raise HTTPException(status_code=404, detail=f"Prompt for '{field}' not found")
     try:
-        audio_bytes, media_type = cached_tts(text)
-        headers = {"Content-Length": str(len(audio_bytes))}
-        return StreamingResponse(io.BytesIO(audio_bytes), media_type=media_type or "application/octet-stream", headers=headers)
+        return _tts_audio_response(text, request)
     except Exception as e:
         print(f"[tts-prompt] error synthesizing '{field}': {e}")
         traceback.print_exc()
@@ -986,6 +1666,121 @@ def submit_claim(payload: ClaimPayload):
 
 # simple in-memory sessions: session_id -> collected dict
 _sessions: Dict[str, Dict[str, Optional[str]]] = {}
+# last activity per session (epoch seconds); used to expire sessions on restore
+_session_touched: Dict[str, float] = {}
+# change tracking per session: {"version": n, "fields": {key: version it last changed at}}
+_session_versions: Dict[str, Dict[str, Any]] = {}
+# derived-field cache per session: {field: (input values, value)}
+_session_derived: Dict[str, Dict[str, Tuple[tuple, Any]]] = {}
+
+from .derived_fields import DerivedField, DerivedFieldEngine
+
+# Fields the server fills in itself. Compensation needs two airport lookups and a
+# haversine, so it is only recomputed when departure, arrival or delay change.
+DERIVED_FIELDS = DerivedFieldEngine([
+    DerivedField(
+        "Compensation Amount",
+        ("Departure Airport", "Arrival Airport", "Delay Hours"),
+        lambda dep, arr, delay: compute_compensation_amount(
+            {"Departure Airport": dep, "Arrival Airport": arr, "Delay Hours": delay}
+        ),
+    ),
+    DerivedField("Claim Status", (), lambda: "New Claim"),
+])
+
+def _fill_derived(session_id: str, data: Dict[str, Any], names: List[str]) -> List[str]:
+    """Fill missing derived fields in data using the session's derived-field cache."""
+    return DERIVED_FIELDS.fill_missing(data, _session_derived.setdefault(session_id, {}), names)
+
+# Sessions are snapshotted to disk on shutdown and restored on startup so a redeploy
+# doesn't lose claims in progress. Set SESSION_SNAPSHOT_PATH="" to disable.
+SESSION_SNAPSHOT_PATH = os.getenv("SESSION_SNAPSHOT_PATH", os.path.join(os.path.dirname(__file__), "session_snapshot.bin"))
+SESSION_TTL_SECONDS = float(os.getenv("SESSION_TTL_SECONDS", str(24 * 3600)))
+
+from .session_snapshot import write_snapshot, read_snapshot
+
+def _touch_session(session_id: str) -> None:
+    _session_touched[session_id] = time.time()
+
+def _drop_session(session_id: str) -> None:
+    _sessions.pop(session_id, None)
+    _session_touched.pop(session_id, None)
+    _session_versions.pop(session_id, None)
+    _session_derived.pop(session_id, None)
+
+def _mark_session_changed(session_id: str, keys) -> int:
+    """
+    Bump the session version if any keys changed and stamp them with it.
+    Returns the current session version.
+    """
+    state = _session_versions.setdefault(session_id, {"version": 0, "fields": {}})
+    keys = list(keys)
+    if keys:
+        state["version"] += 1
+        for k in keys:
+            state["fields"][k] = state["version"]
+    return state["version"]
+
+def _record_session_changes(session_id: str, before: Dict[str, Any]) -> int:
+    """
+    Compare the session against a copy taken before a mutation and record changed keys.
+    """
+    after = _sessions.get(session_id) or {}
+    changed = [k for k in set(after) | set(before) if after.get(k) != before.get(k)]
+    return _mark_session_changed(session_id, changed)
+
+def _session_delta(session_id: str, since: Optional[int]) -> Tuple[int, Dict[str, Any], bool]:
+    """
+    Return (version, changes, resync) for a client that has seen version `since`.
+    When the client's version is unknown or ahead of ours (e.g. a session restored from
+    an older snapshot) the full map is returned with resync=True.
+    """
+    collected = _sessions.get(session_id) or {}
+    state = _session_versions.setdefault(session_id, {"version": 0, "fields": {}})
+    version = state["version"]
+    if since is None or since < 0 or since > version:
+        return version, dict(collected), True
+    fields = state["fields"]
+    changes = {k: collected.get(k) for k, v in fields.items() if v > since}
+    return version, changes, False
+
+@app.on_event("startup")
+def _startup_restore_sessions() -> None:
+    """
+    Restore sessions from the last shutdown snapshot, skipping expired ones.
+    """
+    if not SESSION_SNAPSHOT_PATH:
+        return
+    try:
+        started = time.perf_counter()
+        restored, touched, versions, expired = read_snapshot(SESSION_SNAPSHOT_PATH, SESSION_TTL_SECONDS)
+        for sid, data in restored.items():
+            # sessions created since startup win over the snapshot
+            if sid not in _sessions:
+                _sessions[sid] = data
+                _session_touched[sid] = touched[sid]
+                if sid in versions:
+                    _session_versions[sid] = versions[sid]
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if restored or expired:
+            print(f"[sessions] restored {len(restored)} sessions ({expired} expired) in {elapsed_ms:.1f}ms")
+    except Exception:
+        print("[sessions] failed to restore snapshot:")
+        traceback.print_exc()
+
+@app.on_event("shutdown")
+def _shutdown_snapshot_sessions() -> None:
+    """
+    Write live sessions to SESSION_SNAPSHOT_PATH so they survive a restart.
+    """
+    if not SESSION_SNAPSHOT_PATH:
+        return
+    try:
+        count = write_snapshot(SESSION_SNAPSHOT_PATH, _sessions, _session_touched, _session_versions)
+        print(f"[sessions] wrote snapshot of {count} sessions to {SESSION_SNAPSHOT_PATH}")
+    except Exception:
+        print("[sessions] failed to write snapshot:")
+        traceback.print_exc()
 
 # allow importing prompts from scripts safely (optional)
 main_convo = None
@@ -1007,6 +1802,7 @@ def conversation_start():
     session_id = str(uuid.uuid4())
     _sessions[session_id] = {k: None for k in CLAIM_FIELDS}
     _sessions[session_id]["claim_status_step"] = 0
+    _touch_session(session_id)
 
     # Use main_convo if available, otherwise fallback to hardcoded
     if main_convo:
@@ -1025,10 +1821,455 @@ def conversation_start():
         initial_prompt = f"{intro_line} {open_ended}"
         timeout = 10000
 
-    return {"session_id": session_id, "prompt": initial_prompt, "silence_timeout": timeout}
+    return {"session_id": session_id, "prompt": initial_prompt, "silence_timeout": timeout, "version": _mark_session_changed(session_id, [])}
+
+@app.get("/conversation/{session_id}/state")
+def conversation_state(session_id: str):
+    """
+    Full resync for delta-mode clients: the current session version and the whole collected map.
+    """
+    if session_id not in _sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+    version, collected, _ = _session_delta(session_id, None)
+    return {"session_id": session_id, "version": version, "collected": collected}
+
+def _run_turn(session_id: str, user_text: Optional[str], hint: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Apply one user utterance to the session: extract fields, pick the next prompt.
+    hint replaces the generic re-prompt used when there is no text.
+    Returns the /conversation/respond response body.
+    """
+    collected = _sessions[session_id]
+    prev_collected = dict(collected)
+    _touch_session(session_id)
+
+    # If still no text, ask user to repeat (short-circuit)
+    if not user_text:
+        hint = hint or REPEAT_HINT
+        next_field = next((k for k, v in collected.items() if v is None), None)
+        if next_field:
+            next_prompt = f"{hint} (I'm asking for: {next_field})"
+        else:
+            next_prompt = hint
+        return {"session_id": session_id, "next_prompt": next_prompt, "collected": collected, "done": False, "silence_timeout": 2500}
+
+    # --- Extraction logic ---
+
+    # Passenger Name
+    if not collected.get("Passenger Name"):
+        m = re.search(r'\b(?:my name is|name is|i am|i\'m|im)\s+([A-Za-z][A-ZaZ\s\'\-]{0,80})', user_text, re.I)
+        if m:
+            name = sanitize_passenger_name(m.group(1))
+            if name:
+                collected["Passenger Name"] = name
+
+    # Contact Email
+    if not collected.get("Contact Email"):
+        m = re.search(r'([A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,})', user_text)
+        if m:
+            candidate = m.group(1).strip().strip('.,;:!?)("\'')
+            collected["Contact Email"] = candidate
+
+    # Flight Number
+    if not collected.get("Flight Number"):
+        m = re.search(r'\b([A-Za-z]{1,3}(?:\s+[A-Za-z]{1,3})*)\s*(\d{1,6})\b', user_text)
+        if m:
+            letters = re.sub(r'\s+', '', m.group(1)).upper()
+            numbers = m.group(2)
+            fn = letters + numbers
+            if re.match(r'^[A-Z]{1,4}\d+$', fn):
+                collected["Flight Number"] = fn
+        else:
+            m2 = re.search(r'\bflight\b[^A-Za-z0-9]*([A-Za-z]+)\s*(\d+)\b', user_text, re.I)
+            if m2:
+                letters = re.sub(r'\s+', '', m2.group(1)).upper()
+                numbers = m2.group(2)
+                fn = letters + numbers
+                if re.match(r'^[A-Z]{1,4}\d+$', fn):
+                    collected["Flight Number"] = fn
+
+    # Flight Date
+    if not collected.get("Flight Date"):
+        date_str = parse_date_from_text(user_text)
+        if date_str:
+            collected["Flight Date"] = date_str
+
+    # Airline
+    if not collected.get("Airline"):
+        m = re.search(r'\b(?:flying with|airline|on)\s+([A-Za-z][A-ZaZ\s]{0,80})', user_text, re.I)
+        if m:
+            airline = m.group(1).strip()
+            collected["Airline"] = airline.title()
+    if not collected.get("Airline") and user_text:
+        s = user_text.strip()
+
+        # ignore pure filler/noise
+        filler = {"", "um", "uh", "yeah", "no", "always", "airline", "i don't know", "dont know", "i dunno"}
+        if s.lower() not in filler:
+            # remove common lead-in prepositions/phrases ("to", "on", "with", etc.)
+            s = re.sub(r'^\s*(?:to|on|with|the|i was flying with|i flew with|flying with|flight with)\s+', '', s, flags=re.I)
+
+            # trim punctuation/extra whitespace
+            s = s.strip(" .,!?:;\"'()[]")
+            s = re.sub(r'\s+', ' ', s).strip()
+
+            # collapse duplicated words ("British British Airways")
+            s = re.sub(r'\b(\w+)(?:\s+\1\b)+', r'\1', s, flags=re.I)
+
+            # Title-case tokens
+            parts = [p.capitalize() for p in s.split() if p]
+            normalized = " ".join(parts)
+
+            # Require the airline string to include either "airways" or "airline" (accept "airlines")
+            if re.search(r'\b(?:airways|airline|airlines|always)\b', normalized, flags=re.I):
+                collected["Airline"] = normalized
+                newly_filled = True
+                next_field = next((k for k, v in collected.items() if v is None), None)
+
+    # Departure Airport
+    if not collected.get("Departure Airport"):
+        m_air = re.search(r'\b([A-Za-z][A-ZaZ \-]{1,80}?)\s+airport\b', user_text, re.I)
+        if m_air:
+            name = m_air.group(1).strip()
+            parts = [p.capitalize() for p in re.sub(r'[\-]+', ' ', name).split() if p]
+            collected["Departure Airport"] = " ".join(parts) + " Airport"
+        else:
+            m_from = re.search(r'\b(?:from|depart(?:ed)?\s+from)\s+([A-Za-z][A-ZaZ \-]{1,80}?)\b', user_text, re.I)
+            if m_from:
+                name = m_from.group(1).strip()
+                parts = [p.capitalize() for p in re.sub(r'[\-]+', ' ', name).split() if p]
+                collected["Departure Airport"] = " ".join(parts) + " Airport"
+            else:
+                m_iata = re.search(r'\b(?:from|depart(?:ed)?\s+from)\s+([A-Za-z]{3})\b', user_text, re.I)
+                if m_iata:
+                    collected["Departure Airport"] = m_iata.group(1).upper()
+
+    # Arrival Airport
+    if not collected.get("Arrival Airport"):
+        m_air = re.search(r'\b([A-Za-z][A-ZaZ \-]{1,80}?)\s+airport\b', user_text, re.I)
+        if m_air:
+            name = m_air.group(1).strip()
+            parts = [p.capitalize() for p in re.sub(r'[\-]+', ' ', name).split() if p]
+            collected["Arrival Airport"] = " ".join(parts) + " Airport"
+        else:
+            m_to = re.search(r'\b(?:to|arriv(?:ed|ing)?\s+(?:at|in))\s+([A-Za-z][A-ZaZ \-]{1,80}?)\b', user_text, re.I)
+            if m_to:
+                name = m_to.group(1).strip()
+                parts = [p.capitalize() for p in re.sub(r'[\-]+', ' ', name).split() if p]
+                collected["Arrival Airport"] = " ".join(parts) + " Airport"
+            else:
+                m_iata = re.search(r'\b(?:to|arriv(?:ed|ing)?\s+(?:at|in))\s+([A-Za-z]{3})\b', user_text, re.I)
+                if m_iata:
+                    collected["Arrival Airport"] = m_iata.group(1).upper()
+
+    # Delay Hours
+    if not collected.get("Delay Hours"):
+        delay_str = parse_delay_hours(user_text)
+        if delay_str:
+            collected["Delay Hours"] = delay_str
+
+    # Airline Response
+    if not collected.get("Airline Response"):
+        m = re.search(r'\b(?:airline|they)\s+(?:said|responded|offered)\s+(.{10,200})', user_text, re.I)
+        if m:
+            resp = m.group(1).strip()
+            collected["Airline Response"] = resp
+
+    # Email validation
+    email_invalid = False
+    if collected.get("Contact Email") and not re.match(r'^[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,}$', collected["Contact Email"]):
+        email_invalid = True
+        collected["Contact Email"] = None
+
+    # Determine newly filled and next field
+    newly_filled = any(collected.get(k) != prev_collected.get(k) for k in CLAIM_FIELDS)
+    next_field = next((k for k, v in collected.items() if v is None), None)
+
+    # If we are asking "What did the airline say about your claim?",
+    # accept any user sentence as the Airline Response (no regex required).
+    if next_field == "Airline Response" and user_text:
+        collected["Airline Response"] = user_text.strip()
+        newly_filled = True
+        # advance next_field to the next missing item
+        next_field = next((k for k, v in collected.items() if v is None), None)
+
+    # If we are asking for the flight number, accept many noisy spoken forms:
+    # - contiguous tokens with letters+digits (e.g. "BA123")
+    # - separated letters and digits ("b a 1 2 3" or "ba 123")
+    # - spaced digits collapsed ("5 7 5 7 5 7 2")
+    if next_field == "Flight Number" and user_text:
+        s = re.sub(r'[^\w\s]', ' ', user_text)        # remove punctuation
+        s = re.sub(r'\s+', ' ', s).strip()
+
+        # 1) token containing both letters and digits (best match)
+        tokens = re.findall(r'\b(?=\w*[A-Za-z])(?=\w*\d)\w+\b', s, flags=re.I)
+        found_fn = None
+        for t in tokens:
+            letters = re.sub(r'[^A-Za-z]', '', t).upper()
+            digits = re.sub(r'[^0-9]', '', t)
+            if letters and digits:
+                candidate = letters + digits
+                # basic sanity: letters 1-4, digits 1-6
+                if 1 <= len(letters) <= 4 and 1 <= len(digits) <= 6:
+                    found_fn = candidate
+                    break
+
+        # 2) letter token followed by digit token e.g. "ba 5657"
+        if not found_fn:
+            m = re.search(r'\b([A-Za-z]{1,4})\b\s+(\d{1,6})\b', s, flags=re.I)
+            if m:
+                found_fn = re.sub(r'\s+', '', (m.group(1) + m.group(2))).upper()
+
+        # 3) collapse all spaces and try e.g. "b a 1 2 3" -> "ba123"
+        if not found_fn:
+            collapsed = re.sub(r'\s+', '', s)
+            if re.match(r'^[A-Za-z]{1,4}\d{1,6}$', collapsed, flags=re.I):
+                found_fn = collapsed.upper()
+
+        if found_fn:
+            collected["Flight Number"] = found_fn
+            newly_filled = True
+            next_field = next((k for k, v in collected.items() if v is None), None)
+
+    # Get prompts from main_convo if available, otherwise use hardcoded
+    if main_convo:
+        prompts = main_convo.FIELD_PROMPTS
+    else:
+        # Fallback to hardcoded prompts
+        prompts = {
+            "Passenger Name": "What's your full name as it appears on your ticket?",
+            "Contact Email": "It's quite unfair you had to go through all of that, please type in your email address into the text bar, We'll use it to contact you about your claim.",
+            "Flight Number": "What's your flight number? It usually looks like BA123.",
+            "Flight Date": "When was your flight?",
+            "Airline": "Which airline were you flying with?",
+            "Departure Airport": "Which airport did you depart from?",
+            "Arrival Airport": "Which airport were you supposed to arrive at?",
+            "Delay Hours": "About how many hours was your flight delayed?",
+            "Airline Response": "What did the airline say about your claim?",
+            "Claim Status": "What's the current status of the claim?"
+        }
+
+    # Decide next prompt and timeout
+    if next_field is None:
+        done = True
+        if main_convo:
+            next_prompt = main_convo.get_completion_message()
+            silence_timeout = main_convo.get_timeout("completion")
+        else:
+            next_prompt = "Thank you. I have all the details. Please wait while I prepare your claim review..."
+            silence_timeout = 2500
+        return {
+            "session_id": session_id, 
+            "next_prompt": next_prompt, 
+            "collected": collected, 
+            "done": done, 
+            "silence_timeout": silence_timeout,
+            "redirect_url": f"{FRONTEND_URL}/claim-review.html?session_id={session_id}"
+        }
+    else:
+        done = False
+        silence_timeout = 2500
+        if email_invalid:
+            if main_convo:
+                next_prompt = main_convo.get_invalid_email_message()
+            else:
+                next_prompt = "That doesn't look like a valid email address. Please provide a valid email (for example: name@example.com)."
+        elif next_field == "Claim Status":
+            step = collected.get("claim_status_step", 0)
+            if main_convo:
+                prompt_result = main_convo.get_claim_status_prompt(step, user_text)
+                if len(prompt_result) == 3:  # completion case
+                    next_prompt, new_step, status = prompt_result
+                    collected["Claim Status"] = status
+                    done = True
+                else:  # continue case
+                    next_prompt, new_step = prompt_result
+                    if new_step is not None:
+                        collected["claim_status_step"] = new_step
+            else:
+                # Fallback to hardcoded logic
+                if step == 0:
+                    next_prompt = "Have you submitted a claim before?"
+                    collected["claim_status_step"] = 1
+                elif step == 1:
+                    if "yes" in user_text.lower():
+                        next_prompt = "Have you received compensation?"
+                        collected["claim_status_step"] = 2
+                    elif "no" in user_text.lower():
+                        collected["Claim Status"] = "New Claim"
+                        done = True
+                        next_prompt = "Thank you. I have all the details."
+                    else:
+                        next_prompt = "Please answer yes or no. Have you submitted a claim before?"
+                elif step == 2:
+                    if "yes" in user_text.lower():
+                        collected["Claim Status"] = "Resolved"
+                        done = True
+                        next_prompt = "Thank you. I have all the details."
+                    elif "no" in user_text.lower():
+                        collected["Claim Status"] = "Pending"
+                        done = True
+                        next_prompt = "Thank you. I have all the details."
+                    else:
+                        next_prompt = "Please answer yes or no. Have you received compensation?"
+        else:
+            if main_convo:
+                next_prompt = main_convo.get_field_prompt(next_field, newly_filled)
+            else:
+                # Fallback to hardcoded logic
+                if newly_filled:
+                    next_prompt = prompts.get(next_field, f"Could you tell me your {next_field.lower()}?")
+                else:
+                    examples = {
+                        "Passenger Name": "Please provide your full name as it appears on your ticket (e.g., John Doe).",
+                        "Contact Email": "Please provide your email address (for example: name@example.com).",
+                        "Flight Number": "Please provide your flight number (for example: BA123).",
+                        "Flight Date": "Please provide the date of the flight (Year, Month & Date , an example is., 2023, July 15th).",
+                        "Airline": "Please provide the airline name (for example: British Airways).",
+                        "Departure Airport": "Please provide the departure airport (for example: London Heathrow).",
+                        "Arrival Airport": "Please provide the arrival airport (for example: Amsterdam Schiphol).",
+                        "Delay Hours": "Please tell me the delay duration in hours (for example: 3).",
+                        "Airline Response": "Please describe how the airline responded (for example: they offered meal vouchers)."
+                    }
+                    specific = examples.get(next_field)
+                    if specific:
+                        next_prompt = f"Sorry, I didn't catch that. {specific} You also can use the text bar."
+                    else:
+                        next_prompt = f"Could you please provide your {next_field.lower()}?"
+
+    # Auto-fill Compensation Amount if it's the next missing field (do not ask user)
+    try:
+        # prefer space key, but support underscore forms
+        comp_key_space = "Compensation Amount"
+        comp_key_uscore = "Compensation_Amount"
+        current_next = next((k for k, v in collected.items() if v is None), None)
+        if current_next in (comp_key_space, comp_key_uscore):
+            if _fill_derived(session_id, collected, [comp_key_space]):
+                newly_filled = True
+                # advance to next missing
+                next_field = next((k for k, v in collected.items() if v is None), None)
+    except Exception as _e:
+        print("[conversation_respond] compensation auto-fill error:", _e)
+
+    # Set timeout if not already set
+    if 'silence_timeout' not in locals():
+        if main_convo:
+            silence_timeout = main_convo.get_timeout("standard")
+        else:
+            silence_timeout = 2500
+
+    # persist session
+    _sessions[session_id] = collected
+
+    return {"session_id": session_id, "next_prompt": next_prompt, "collected": collected, "done": done, "silence_timeout": silence_timeout}
+
+def _normalize_user_text(user_text: Optional[str]) -> Optional[str]:
+    """Normalize common noisy transcripts before extraction."""
+    if user_text:
+        # collapse immediate duplicated words: "my my" -> "my"
+        user_text = re.sub(r'\b(\w+)(?:\s+\1\b)+', r'\1', user_text, flags=re.I)
+
+        # collapse sequences of single letters separated by spaces into contiguous letters:
+        # e.g. "b a" -> "ba", "b a 5 6" -> "ba56", "5 6 5 7" -> "5657"
+        def _collapse_spaced_sequences(s: str) -> str:
+            # letter groups of 2+ single-letter tokens -> join
+            s = re.sub(r'\b(?:(?:[A-Za-z])\s+){1,}[A-ZaZ]\b',
+                       lambda m: m.group(0).replace(' ', ''), s)
+            # letter group followed by digits: "b a 123" -> "ba123"
+            s = re.sub(r'\b((?:[A-ZaZ]\s+)+[A-ZaZ])\s+(\d+)\b',
+                       lambda m: m.group(1).replace(' ', '') + m.group(2), s)
+            # sequences of spaced digits -> join "5 6 5 7" -> "5657"
+            s = re.sub(r'\b(\d(?:\s+\d){1,})\b', lambda m: m.group(0).replace(' ', ''), s)
+            return s
+
+        user_text = _collapse_spaced_sequences(user_text)
+        # trim extra whitespace
+        user_text = re.sub(r'\s+', ' ', user_text).strip()
+    return user_text
+
+# Turn responses carry next_prompt_audio: a /tts-stream URL for the next prompt's audio,
+# which starts synthesising as soon as the prompt is known. The client fetches it right
+# away and streams it, joining the in-flight upstream stream instead of starting a new
+# one after the turn; the URL is text-addressed, so any worker can serve it. With
+# inline_audio=true the audio itself (base64) is included once ready.
+TURN_PROMPT_AUDIO = os.getenv("TURN_PROMPT_AUDIO", "1").lower() not in ("0", "false", "no", "off")
+TURN_AUDIO_INLINE_MAX_BYTES = int(os.getenv("TURN_AUDIO_INLINE_MAX_BYTES", str(256 * 1024)))
+TURN_AUDIO_INLINE_WAIT_MS = int(os.getenv("TURN_AUDIO_INLINE_WAIT_MS", "3000"))
+_speculative_tts: set = set()
+
+async def _next_prompt_audio(text: Optional[str], inline: bool = False) -> Optional[Dict[str, Any]]:
+    if not TURN_PROMPT_AUDIO or not text or not ELEVEN_API_KEY or not ELEVEN_VOICE_ID:
+        return None
+    # whole text (chunked=0) so the fetch joins the speculative stream even if it arrives first
+    ref: Dict[str, Any] = {"url": "/tts-stream?" + urllib.parse.urlencode({"text": text, "chunked": 0}), "ready": False}
+    cached = _tts_cached_audio(text)
+    if cached is None:
+        task = asyncio.ensure_future(cached_tts_async(text))
+        _speculative_tts.add(task)
+        task.add_done_callback(_speculative_tts.discard)
+        if inline:
+            try:
+                cached = await asyncio.wait_for(asyncio.shield(task), TURN_AUDIO_INLINE_WAIT_MS / 1000.0)
+            except asyncio.TimeoutError:
+                pass
+            if cached is not None and cached[0] == _make_dummy_mp3():
+                cached = None
+    if cached is not None:
+        ref.update(ready=True, media_type=cached[1], bytes=len(cached[0]))
+        if inline and len(cached[0]) <= TURN_AUDIO_INLINE_MAX_BYTES:
+            ref["data"] = base64.b64encode(cached[0]).decode("ascii")
+    return ref
+
+def _apply_turn(session_id: str, user_text: Optional[str], hint: Optional[str] = None) -> Dict[str, Any]:
+    """Run one turn and stamp the response with the resulting session version."""
+    before = dict(_sessions[session_id])
+    result = _run_turn(session_id, user_text, hint)
+    result["version"] = _record_session_changes(session_id, before)
+    return result
+
+# Idempotency-Key support: retried turns / submissions replay the stored response
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "2048"))
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600)))
+
+from .idempotency import IdempotencyCache
+
+_idempotency = IdempotencyCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_TTL_SECONDS)
+
+async def _run_idempotent(request: Request, scope: Tuple[str, ...], handler):
+    """
+    Run handler() at most once per Idempotency-Key header within scope.
+    Replayed responses are marked with an Idempotent-Replayed header.
+    """
+    key = request.headers.get("Idempotency-Key")
+    if not key:
+        return await handler()
+    result, replayed = await _idempotency.run(scope + (key,), handler)
+    if replayed:
+        return JSONResponse(content=result, headers={"Idempotent-Replayed": "true"})
+    return result
 
 @app.post("/conversation/respond")
-async def conversation_respond(session_id: str, request: Request, file: UploadFile | None = File(None), payload: dict | str | None = Body(None)):
+async def conversation_respond(session_id: str, request: Request, file: UploadFile | None = File(None), payload: dict | str | None = Body(None), delta: bool = False, since: Optional[int] = None, inline_audio: bool = False):
+    """
+    Process one conversation turn: JSON/text, multipart audio (`file`), or a raw audio
+    body sent with Content-Type application/octet-stream or audio/* (optional
+    X-Audio-Filename header).
+    With delta=true the response carries only the fields changed after version `since`
+    instead of the full `collected` map; see /conversation/{session_id}/state for a full resync.
+    Send an Idempotency-Key header to make retries replay the first response.
+    next_prompt_audio references the next prompt's audio; inline_audio=true embeds it (base64).
+    """
+    return await _run_idempotent(
+        request,
+        ("conversation/respond", session_id),
+        lambda: _conversation_respond(session_id, request, file, payload, delta, since, inline_audio),
+    )
+
+async def _conversation_respond(session_id: str, request: Request, file: Optional[UploadFile], payload: Any, delta: bool, since: Optional[int], inline_audio: bool = False):
+    raw_audio = None
+    if file is None and _is_raw_audio_request(request):
+        # outside the try below so an oversized body is a real 413
+        raw_audio = await _read_raw_audio(request)
     try:
         if session_id not in _sessions:
             raise HTTPException(status_code=400, detail="invalid session_id")
@@ -1046,7 +2287,7 @@ async def conversation_respond(session_id: str, request: Request, file: UploadFi
             elif isinstance(payload, str):
                 user_text = payload.strip()
 
-        if user_text is None:
+        if user_text is None and raw_audio is None:
             try:
                 j = await request.json()
                 if isinstance(j, dict) and "text" in j:
@@ -1070,388 +2311,29 @@ async def conversation_respond(session_id: str, request: Request, file: UploadFi
                     user_text = None
 
         # --- NEW: normalize common noisy transcripts before extraction ---
-        if user_text:
-            # collapse immediate duplicated words: "my my" -> "my"
-            user_text = re.sub(r'\b(\w+)(?:\s+\1\b)+', r'\1', user_text, flags=re.I)
-
-            # collapse sequences of single letters separated by spaces into contiguous letters:
-            # e.g. "b a" -> "ba", "b a 5 6" -> "ba56", "5 6 5 7" -> "5657"
-            def _collapse_spaced_sequences(s: str) -> str:
-                # letter groups of 2+ single-letter tokens -> join
-                s = re.sub(r'\b(?:(?:[A-Za-z])\s+){1,}[A-ZaZ]\b',
-                           lambda m: m.group(0).replace(' ', ''), s)
-                # letter group followed by digits: "b a 123" -> "ba123"
-                s = re.sub(r'\b((?:[A-ZaZ]\s+)+[A-ZaZ])\s+(\d+)\b',
-                           lambda m: m.group(1).replace(' ', '') + m.group(2), s)
-                # sequences of spaced digits -> join "5 6 5 7" -> "5657"
-                s = re.sub(r'\b(\d(?:\s+\d){1,})\b', lambda m: m.group(0).replace(' ', ''), s)
-                return s
-
-            user_text = _collapse_spaced_sequences(user_text)
-            # trim extra whitespace
-            user_text = re.sub(r'\s+', ' ', user_text).strip()
-        # If no text and file present, run STT (ElevenLabs)
-        if user_text is None and file is not None:
-            if not ELEVEN_API_KEY:
+        user_text = _normalize_user_text(user_text)
+        audio_report: Dict[str, Any] = {}
+        # If no text and audio present, run STT
+        if user_text is None and (file is not None or raw_audio is not None):
+            if not _stt.configured:
                 raise HTTPException(status_code=500, detail="ELEVEN_API_KEY not set")
-            suffix = os.path.splitext(file.filename)[1] or ".wav"
-            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp:
-                shutil.copyfileobj(file.file, tmp)
-                tmp_path = tmp.name
-
-            send_path = tmp_path
-            remove_send = False
-            try:
-                send_path, remove_send = _maybe_transcode_to_wav(tmp_path)
-                url = "https://api.elevenlabs.io/v1/speech-to-text"
-                headers = {"xi-api-key": ELEVEN_API_KEY, "Accept": "application/json"}
-                with open(send_path, "rb") as fh:
-                    ctype = mimetypes.guess_type(send_path)[0] or "application/octet-stream"
-                    files = {"file": (os.path.basename(send_path), fh, ctype)}
-                    data = {"model_id": ELEVEN_STT_MODEL}
-                    resp = requests.post(url, headers=headers, files=files, data=data, timeout=30)
-                if resp.status_code >= 400:
-                    print("ElevenLabs STT error (respond):", resp.status_code, resp.text)
-                    raise HTTPException(status_code=502, detail={"eleven_error": resp.text, "status": resp.status_code})
-                body = resp.json()
-                user_text = (body.get("text") or body.get("transcript") or "").strip()
-            finally:
-                try:
-                    if os.path.exists(tmp_path):
-                        os.unlink(tmp_path)
-                except Exception:
-                    pass
-                try:
-                    if remove_send and send_path and os.path.exists(send_path):
-                        os.unlink(send_path)
-                except Exception:
-                    pass
-
-        collected = _sessions[session_id]
-        prev_collected = dict(collected)
-
-        # If still no text, ask user to repeat (short-circuit)
-        if not user_text:
-            hint = "I didn't catch that — could you repeat your response? You also can use the text bar."
-            next_field = next((k for k, v in collected.items() if v is None), None)
-            if next_field:
-                next_prompt = f"{hint} (I'm asking for: {next_field})"
+            if raw_audio is not None:
+                user_text = await _transcribe_bytes(raw_audio[0], raw_audio[1], audio_report)
             else:
-                next_prompt = hint
-            return {"session_id": session_id, "next_prompt": next_prompt, "collected": collected, "done": False, "silence_timeout": 2500}
-
-        # --- Extraction logic ---
-
-        # Passenger Name
-        if not collected.get("Passenger Name"):
-            m = re.search(r'\b(?:my name is|name is|i am|i\'m|im)\s+([A-Za-z][A-ZaZ\s\'\-]{0,80})', user_text, re.I)
-            if m:
-                name = sanitize_passenger_name(m.group(1))
-                if name:
-                    collected["Passenger Name"] = name
-
-        # Contact Email
-        if not collected.get("Contact Email"):
-            m = re.search(r'([A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,})', user_text)
-            if m:
-                candidate = m.group(1).strip().strip('.,;:!?)("\'')
-                collected["Contact Email"] = candidate
-
-        # Flight Number
-        if not collected.get("Flight Number"):
-            m = re.search(r'\b([A-Za-z]{1,3}(?:\s+[A-Za-z]{1,3})*)\s*(\d{1,6})\b', user_text)
-            if m:
-                letters = re.sub(r'\s+', '', m.group(1)).upper()
-                numbers = m.group(2)
-                fn = letters + numbers
-                if re.match(r'^[A-Z]{1,4}\d+$', fn):
-                    collected["Flight Number"] = fn
-            else:
-                m2 = re.search(r'\bflight\b[^A-Za-z0-9]*([A-Za-z]+)\s*(\d+)\b', user_text, re.I)
-                if m2:
-                    letters = re.sub(r'\s+', '', m2.group(1)).upper()
-                    numbers = m2.group(2)
-                    fn = letters + numbers
-                    if re.match(r'^[A-Z]{1,4}\d+$', fn):
-                        collected["Flight Number"] = fn
-
-        # Flight Date
-        if not collected.get("Flight Date"):
-            date_str = parse_date_from_text(user_text)
-            if date_str:
-                collected["Flight Date"] = date_str
-
-        # Airline
-        if not collected.get("Airline"):
-            m = re.search(r'\b(?:flying with|airline|on)\s+([A-Za-z][A-ZaZ\s]{0,80})', user_text, re.I)
-            if m:
-                airline = m.group(1).strip()
-                collected["Airline"] = airline.title()
-        if not collected.get("Airline") and user_text:
-            s = user_text.strip()
-
-            # ignore pure filler/noise
-            filler = {"", "um", "uh", "yeah", "no", "always", "airline", "i don't know", "dont know", "i dunno"}
-            if s.lower() not in filler:
-                # remove common lead-in prepositions/phrases ("to", "on", "with", etc.)
-                s = re.sub(r'^\s*(?:to|on|with|the|i was flying with|i flew with|flying with|flight with)\s+', '', s, flags=re.I)
-
-                # trim punctuation/extra whitespace
-                s = s.strip(" .,!?:;\"'()[]")
-                s = re.sub(r'\s+', ' ', s).strip()
-
-                # collapse duplicated words ("British British Airways")
-                s = re.sub(r'\b(\w+)(?:\s+\1\b)+', r'\1', s, flags=re.I)
-
-                # Title-case tokens
-                parts = [p.capitalize() for p in s.split() if p]
-                normalized = " ".join(parts)
-
-                # Require the airline string to include either "airways" or "airline" (accept "airlines")
-                if re.search(r'\b(?:airways|airline|airlines|always)\b', normalized, flags=re.I):
-                    collected["Airline"] = normalized
-                    newly_filled = True
-                    next_field = next((k for k, v in collected.items() if v is None), None)
-
-        # Departure Airport
-        if not collected.get("Departure Airport"):
-            m_air = re.search(r'\b([A-Za-z][A-ZaZ \-]{1,80}?)\s+airport\b', user_text, re.I)
-            if m_air:
-                name = m_air.group(1).strip()
-                parts = [p.capitalize() for p in re.sub(r'[\-]+', ' ', name).split() if p]
-                collected["Departure Airport"] = " ".join(parts) + " Airport"
-            else:
-                m_from = re.search(r'\b(?:from|depart(?:ed)?\s+from)\s+([A-Za-z][A-ZaZ \-]{1,80}?)\b', user_text, re.I)
-                if m_from:
-                    name = m_from.group(1).strip()
-                    parts = [p.capitalize() for p in re.sub(r'[\-]+', ' ', name).split() if p]
-                    collected["Departure Airport"] = " ".join(parts) + " Airport"
-                else:
-                    m_iata = re.search(r'\b(?:from|depart(?:ed)?\s+from)\s+([A-Za-z]{3})\b', user_text, re.I)
-                    if m_iata:
-                        collected["Departure Airport"] = m_iata.group(1).upper()
-
-        # Arrival Airport
-        if not collected.get("Arrival Airport"):
-            m_air = re.search(r'\b([A-Za-z][A-ZaZ \-]{1,80}?)\s+airport\b', user_text, re.I)
-            if m_air:
-                name = m_air.group(1).strip()
-                parts = [p.capitalize() for p in re.sub(r'[\-]+', ' ', name).split() if p]
-                collected["Arrival Airport"] = " ".join(parts) + " Airport"
-            else:
-                m_to = re.search(r'\b(?:to|arriv(?:ed|ing)?\s+(?:at|in))\s+([A-Za-z][A-ZaZ \-]{1,80}?)\b', user_text, re.I)
-                if m_to:
-                    name = m_to.group(1).strip()
-                    parts = [p.capitalize() for p in re.sub(r'[\-]+', ' ', name).split() if p]
-                    collected["Arrival Airport"] = " ".join(parts) + " Airport"
-                else:
-                    m_iata = re.search(r'\b(?:to|arriv(?:ed|ing)?\s+(?:at|in))\s+([A-Za-z]{3})\b', user_text, re.I)
-                    if m_iata:
-                        collected["Arrival Airport"] = m_iata.group(1).upper()
-
-        # Delay Hours
-        if not collected.get("Delay Hours"):
-            delay_str = parse_delay_hours(user_text)
-            if delay_str:
-                collected["Delay Hours"] = delay_str
-
-        # Airline Response
-        if not collected.get("Airline Response"):
-            m = re.search(r'\b(?:airline|they)\s+(?:said|responded|offered)\s+(.{10,200})', user_text, re.I)
-            if m:
-                resp = m.group(1).strip()
-                collected["Airline Response"] = resp
-
-        # Email validation
-        email_invalid = False
-        if collected.get("Contact Email") and not re.match(r'^[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,}$', collected["Contact Email"]):
-            email_invalid = True
-            collected["Contact Email"] = None
-
-        # Determine newly filled and next field
-        newly_filled = any(collected.get(k) != prev_collected.get(k) for k in CLAIM_FIELDS)
-        next_field = next((k for k, v in collected.items() if v is None), None)
-
-        # If we are asking "What did the airline say about your claim?",
-        # accept any user sentence as the Airline Response (no regex required).
-        if next_field == "Airline Response" and user_text:
-            collected["Airline Response"] = user_text.strip()
-            newly_filled = True
-            # advance next_field to the next missing item
-            next_field = next((k for k, v in collected.items() if v is None), None)
-
-        # If we are asking for the flight number, accept many noisy spoken forms:
-        # - contiguous tokens with letters+digits (e.g. "BA123")
-        # - separated letters and digits ("b a 1 2 3" or "ba 123")
-        # - spaced digits collapsed ("5 7 5 7 5 7 2")
-        if next_field == "Flight Number" and user_text:
-            s = re.sub(r'[^\w\s]', ' ', user_text)        # remove punctuation
-            s = re.sub(r'\s+', ' ', s).strip()
-
-            # 1) token containing both letters and digits (best match)
-            tokens = re.findall(r'\b(?=\w*[A-Za-z])(?=\w*\d)\w+\b', s, flags=re.I)
-            found_fn = None
-            for t in tokens:
-                letters = re.sub(r'[^A-Za-z]', '', t).upper()
-                digits = re.sub(r'[^0-9]', '', t)
-                if letters and digits:
-                    candidate = letters + digits
-                    # basic sanity: letters 1-4, digits 1-6
-                    if 1 <= len(letters) <= 4 and 1 <= len(digits) <= 6:
-                        found_fn = candidate
-                        break
-
-            # 2) letter token followed by digit token e.g. "ba 5657"
-            if not found_fn:
-                m = re.search(r'\b([A-Za-z]{1,4})\b\s+(\d{1,6})\b', s, flags=re.I)
-                if m:
-                    found_fn = re.sub(r'\s+', '', (m.group(1) + m.group(2))).upper()
-
-            # 3) collapse all spaces and try e.g. "b a 1 2 3" -> "ba123"
-            if not found_fn:
-                collapsed = re.sub(r'\s+', '', s)
-                if re.match(r'^[A-Za-z]{1,4}\d{1,6}$', collapsed, flags=re.I):
-                    found_fn = collapsed.upper()
-
-            if found_fn:
-                collected["Flight Number"] = found_fn
-                newly_filled = True
-                next_field = next((k for k, v in collected.items() if v is None), None)
-
-        # Get prompts from main_convo if available, otherwise use hardcoded
-        if main_convo:
-            prompts = main_convo.FIELD_PROMPTS
-        else:
-            # Fallback to hardcoded prompts
-            prompts = {
-                "Passenger Name": "What's your full name as it appears on your ticket?",
-                "Contact Email": "It's quite unfair you had to go through all of that, please type in your email address into the text bar, We'll use it to contact you about your claim.",
-                "Flight Number": "What's your flight number? It usually looks like BA123.",
-                "Flight Date": "When was your flight?",
-                "Airline": "Which airline were you flying with?",
-                "Departure Airport": "Which airport did you depart from?",
-                "Arrival Airport": "Which airport were you supposed to arrive at?",
-                "Delay Hours": "About how many hours was your flight delayed?",
-                "Airline Response": "What did the airline say about your claim?",
-                "Claim Status": "What's the current status of the claim?"
-            }
-
-        # Decide next prompt and timeout
-        if next_field is None:
-            done = True
-            if main_convo:
-                next_prompt = main_convo.get_completion_message()
-                silence_timeout = main_convo.get_timeout("completion")
-            else:
-                next_prompt = "Thank you. I have all the details. Please wait while I prepare your claim review..."
-                silence_timeout = 2500
-            return {
-                "session_id": session_id, 
-                "next_prompt": next_prompt, 
-                "collected": collected, 
-                "done": done, 
-                "silence_timeout": silence_timeout,
-                "redirect_url": f"{FRONTEND_URL}/claim-review.html?session_id={session_id}"
-            }
-        else:
-            done = False
-            silence_timeout = 2500
-            if email_invalid:
-                if main_convo:
-                    next_prompt = main_convo.get_invalid_email_message()
-                else:
-                    next_prompt = "That doesn't look like a valid email address. Please provide a valid email (for example: name@example.com)."
-            elif next_field == "Claim Status":
-                step = collected.get("claim_status_step", 0)
-                if main_convo:
-                    prompt_result = main_convo.get_claim_status_prompt(step, user_text)
-                    if len(prompt_result) == 3:  # completion case
-                        next_prompt, new_step, status = prompt_result
-                        collected["Claim Status"] = status
-                        done = True
-                    else:  # continue case
-                        next_prompt, new_step = prompt_result
-                        if new_step is not None:
-                            collected["claim_status_step"] = new_step
-                else:
-                    # Fallback to hardcoded logic
-                    if step == 0:
-                        next_prompt = "Have you submitted a claim before?"
-                        collected["claim_status_step"] = 1
-                    elif step == 1:
-                        if "yes" in user_text.lower():
-                            next_prompt = "Have you received compensation?"
-                            collected["claim_status_step"] = 2
-                        elif "no" in user_text.lower():
-                            collected["Claim Status"] = "New Claim"
-                            done = True
-                            next_prompt = "Thank you. I have all the details."
-                        else:
-                            next_prompt = "Please answer yes or no. Have you submitted a claim before?"
-                    elif step == 2:
-                        if "yes" in user_text.lower():
-                            collected["Claim Status"] = "Resolved"
-                            done = True
-                            next_prompt = "Thank you. I have all the details."
-                        elif "no" in user_text.lower():
-                            collected["Claim Status"] = "Pending"
-                            done = True
-                            next_prompt = "Thank you. I have all the details."
-                        else:
-                            next_prompt = "Please answer yes or no. Have you received compensation?"
-            else:
-                if main_convo:
-                    next_prompt = main_convo.get_field_prompt(next_field, newly_filled)
-                else:
-                    # Fallback to hardcoded logic
-                    if newly_filled:
-                        next_prompt = prompts.get(next_field, f"Could you tell me your {next_field.lower()}?")
-                    else:
-                        examples = {
-                            "Passenger Name": "Please provide your full name as it appears on your ticket (e.g., John Doe).",
-                            "Contact Email": "Please provide your email address (for example: name@example.com).",
-                            "Flight Number": "Please provide your flight number (for example: BA123).",
-                            "Flight Date": "Please provide the date of the flight (Year, Month & Date , an example is., 2023, July 15th).",
-                            "Airline": "Please provide the airline name (for example: British Airways).",
-                            "Departure Airport": "Please provide the departure airport (for example: London Heathrow).",
-                            "Arrival Airport": "Please provide the arrival airport (for example: Amsterdam Schiphol).",
-                            "Delay Hours": "Please tell me the delay duration in hours (for example: 3).",
-                            "Airline Response": "Please describe how the airline responded (for example: they offered meal vouchers)."
-                        }
-                        specific = examples.get(next_field)
-                        if specific:
-                            next_prompt = f"Sorry, I didn't catch that. {specific} You also can use the text bar."
-                        else:
-                            next_prompt = f"Could you please provide your {next_field.lower()}?"
-
-        # Auto-fill Compensation Amount if it's the next missing field (do not ask user)
-        try:
-            # prefer space key, but support underscore forms
-            comp_key_space = "Compensation Amount"
-            comp_key_uscore = "Compensation_Amount"
-            current_next = next((k for k, v in collected.items() if v is None), None)
-            if current_next in (comp_key_space, comp_key_uscore):
-                comp_val = compute_compensation_amount(collected)
-                if comp_val is not None:
-                    collected[comp_key_space] = comp_val
-                    collected[comp_key_uscore] = comp_val
-                    newly_filled = True
-                    # advance to next missing
-                    next_field = next((k for k, v in collected.items() if v is None), None)
-        except Exception as _e:
-            print("[conversation_respond] compensation auto-fill error:", _e)
-
-        # Set timeout if not already set
-        if 'silence_timeout' not in locals():
-            if main_convo:
-                silence_timeout = main_convo.get_timeout("standard")
-            else:
-                silence_timeout = 2500
-
-        # persist session
-        _sessions[session_id] = collected
-
-        return {"session_id": session_id, "next_prompt": next_prompt, "collected": collected, "done": done, "silence_timeout": silence_timeout}
+                user_text = await _transcribe_upload_async(file, audio_report)
+
+        result = _apply_turn(session_id, user_text, AUDIO_REJECT_HINTS.get(audio_report.get("rejected")))
+        prompt_audio = await _next_prompt_audio(result.get("next_prompt"), inline_audio)
+        if prompt_audio:
+            result["next_prompt_audio"] = prompt_audio
+        if audio_report:
+            result["audio"] = audio_report
+        if delta:
+            version, changes, resync = _session_delta(session_id, since)
+            result.pop("collected", None)
+            result["changes"] = changes
+            result["resync"] = resync
+        return result
 
     except Exception as e:
         print(f"Error in conversation_respond: {e}")
@@ -1464,6 +2346,149 @@ async def conversation_respond(session_id: str, request: Request, file: UploadFi
             timeout = 2500
         return {"error": str(e), "session_id": session_id, "next_prompt": error_message, "collected": {}, "done": False, "silence_timeout": timeout}
 
+# /conversation/stream: audio is streamed while the user speaks. A partial transcript of
+# everything received so far is requested every STREAM_PARTIAL_INTERVAL_MS (0 disables
+# partials); if the last partial already covers the whole utterance it becomes the final.
+# A container stream (webm/ogg) can't be decoded from a mid-stream offset, so each partial
+# re-sends the utterance from the start; STREAM_MAX_PARTIALS caps them per utterance so
+# the STT cost of a long utterance stays linear.
+STREAM_PARTIAL_INTERVAL_MS = int(os.getenv("STREAM_PARTIAL_INTERVAL_MS", "1500"))
+STREAM_MAX_PARTIALS = int(os.getenv("STREAM_MAX_PARTIALS", "3"))
+STREAM_MAX_BYTES = int(os.getenv("STREAM_MAX_BYTES", str(10 * 1024 * 1024)))
+
+class _StreamedUtterance:
+    """Audio received for one utterance plus the partial transcription state."""
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.partial_task: Optional[asyncio.Task] = None
+        self.partial_task_len = 0
+        self.partial_len = 0
+        self.partial_text = ""
+        self.partials = 0
+        self.last_partial_at = 0.0
+
+    def cancel_partial(self) -> None:
+        if self.partial_task is not None and not self.partial_task.done():
+            self.partial_task.cancel()
+
+@app.websocket("/conversation/stream")
+async def conversation_stream(websocket: WebSocket, session_id: str):
+    """
+    Streaming conversation turns over a WebSocket.
+
+    Client -> server:
+      binary frames                 audio chunks of the current utterance (e.g. MediaRecorder webm)
+      {"type": "end"}               utterance finished: transcribe and run the turn
+      {"type": "text", "text": ..}  typed answer, runs the turn directly
+    Server -> client:
+      {"type": "partial", "text": .., "bytes": n}    transcript of the first n bytes
+      {"type": "final", "text": ..}                  transcript of the whole utterance
+      {"type": "turn", ...}                          same body as /conversation/respond
+      {"type": "error", "detail": ..}
+    """
+    await websocket.accept()
+    if session_id not in _sessions:
+        await websocket.send_json({"type": "error", "detail": "invalid session_id"})
+        await websocket.close(code=4400)
+        return
+
+    utt = _StreamedUtterance()
+    send_lock = asyncio.Lock()
+
+    async def send_json(message: Dict[str, Any]) -> None:
+        # partials are sent from their own task; frames must not interleave with the main loop's
+        async with send_lock:
+            await websocket.send_json(message)
+
+    async def run_partial(current: _StreamedUtterance, size: int) -> None:
+        try:
+            text = await _transcribe_bytes(bytes(current.buf[:size]), "stream.webm", use_cache=False)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("[conversation/stream] partial transcription failed:", e)
+            return
+        current.partial_len, current.partial_text = size, text
+        await send_json({"type": "partial", "text": text, "bytes": size})
+
+    async def send_turn(user_text: Optional[str], hint: Optional[str] = None) -> None:
+        try:
+            result = _apply_turn(session_id, user_text, hint)
+        except Exception as e:
+            traceback.print_exc()
+            await send_json({"type": "error", "detail": str(e)})
+            return
+        prompt_audio = await _next_prompt_audio(result.get("next_prompt"))
+        if prompt_audio:
+            result["next_prompt_audio"] = prompt_audio
+        await send_json({"type": "turn", **result})
+
+    try:
+        while True:
+            msg = await websocket.receive()
+            if msg["type"] == "websocket.disconnect":
+                break
+            if session_id not in _sessions:
+                await send_json({"type": "error", "detail": "session ended"})
+                break
+
+            if msg.get("bytes"):
+                utt.buf.extend(msg["bytes"])
+                if len(utt.buf) > STREAM_MAX_BYTES:
+                    utt.cancel_partial()
+                    utt = _StreamedUtterance()
+                    await send_json({"type": "error", "detail": "utterance too large"})
+                    continue
+                now = time.monotonic()
+                idle = utt.partial_task is None or utt.partial_task.done()
+                if (STREAM_PARTIAL_INTERVAL_MS > 0 and _stt.configured and idle
+                        and utt.partials < STREAM_MAX_PARTIALS
+                        and (now - utt.last_partial_at) * 1000 >= STREAM_PARTIAL_INTERVAL_MS):
+                    utt.last_partial_at = now
+                    utt.partials += 1
+                    utt.partial_task_len = len(utt.buf)
+                    utt.partial_task = asyncio.create_task(run_partial(utt, len(utt.buf)))
+                continue
+
+            try:
+                control = json.loads(msg.get("text") or "{}")
+            except ValueError:
+                await send_json({"type": "error", "detail": "invalid message"})
+                continue
+            kind = control.get("type") if isinstance(control, dict) else None
+
+            if kind == "text":
+                await send_turn(_normalize_user_text((control.get("text") or "").strip()))
+            elif kind == "end":
+                # an in-flight partial that covers everything is as good as a final
+                if utt.partial_task is not None and not utt.partial_task.done():
+                    if utt.partial_task_len == len(utt.buf):
+                        await asyncio.gather(utt.partial_task, return_exceptions=True)
+                    else:
+                        utt.cancel_partial()
+                text = ""
+                audio_report: Dict[str, Any] = {}
+                if utt.buf:
+                    if utt.partial_len == len(utt.buf):
+                        text = utt.partial_text
+                    elif not _stt.configured:
+                        await send_json({"type": "error", "detail": "ELEVEN_API_KEY not set"})
+                    else:
+                        try:
+                            text = await _transcribe_bytes(bytes(utt.buf), "stream.webm", audio_report)
+                        except HTTPException as he:
+                            print("[conversation/stream] transcription failed:", he.detail)
+                utt = _StreamedUtterance()
+                await send_json({"type": "final", "text": text, **({"audio": audio_report} if audio_report else {})})
+                await send_turn(text, AUDIO_REJECT_HINTS.get(audio_report.get("rejected")))
+            else:
+                await send_json({"type": "error", "detail": f"unknown message type: {kind}"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        utt.cancel_partial()
+
 @app.get("/claim-review/{session_id}")
 def get_claim_review(session_id: str):
     """
@@ -1473,21 +2498,10 @@ def get_claim_review(session_id: str):
         raise HTTPException(status_code=404, detail="Session not found")
     
     collected = _sessions[session_id]
-    # compute compensation if missing
-    comp_key_space = "Compensation Amount"
-    comp_key_uscore = "Compensation_Amount"
-    if not collected.get(comp_key_space) and not collected.get(comp_key_uscore):
-        comp_val = compute_compensation_amount(collected)
-        if comp_val:
-            collected[comp_key_space] = comp_val
-            collected[comp_key_uscore] = comp_val
-            _sessions[session_id] = collected
-
-    # ensure Claim Status default
-    if not collected.get("Claim Status") and not collected.get("Claim_Status"):
-        collected["Claim Status"] = "New Claim"
-        collected["Claim_Status"] = "New Claim"
-        _sessions[session_id] = collected
+    before = dict(collected)
+    # compute compensation if missing and ensure Claim Status default
+    _fill_derived(session_id, collected, ["Compensation Amount", "Claim Status"])
+    _record_session_changes(session_id, before)
 
     clean_data = {k: v for k, v in collected.items() if not k.startswith('claim_status_step')}
     return {
@@ -1537,6 +2551,7 @@ async def upload_document(
     if 'uploaded_documents' not in _sessions[session_id]:
         _sessions[session_id]['uploaded_documents'] = []
     
+    _touch_session(session_id)
     _sessions[session_id]['uploaded_documents'].append({
         "filename": safe_filename,
         "original_name": file.filename,
@@ -1545,6 +2560,7 @@ async def upload_document(
         "upload_time": timestamp,
         "file_size": len(file_content)
     })
+    _mark_session_changed(session_id, ["uploaded_documents"])
     
     return {
         "message": "File uploaded successfully",
@@ -1591,14 +2607,25 @@ def delete_document(session_id: str, filename: str):
     
     # Remove from session
     documents.remove(doc_to_remove)
+    _mark_session_changed(session_id, ["uploaded_documents"])
     
     return {"message": "Document deleted successfully"}
 
 @app.post("/claim-submit-final")
 async def submit_final_claim(request: Request):
     """
-    Accept final claim data with documents and send to Zoro CRM
+    Accept final claim data with documents and send to Zoro CRM.
+    Send an Idempotency-Key header so a retried submission can't create a second lead.
     """
+    try:
+        body = await request.json()
+    except Exception:
+        body = None
+    # a key reused by another session must not replay this session's submission
+    session_id = body.get("session_id") if isinstance(body, dict) else None
+    return await _run_idempotent(request, ("claim-submit-final", session_id), lambda: _submit_final_claim(request))
+
+async def _submit_final_claim(request: Request):
     try:
         data = await request.json()
     except Exception:
@@ -1621,17 +2648,9 @@ async def submit_final_claim(request: Request):
     # Remove internal fields
     clean_data = {k: v for k, v in final_data.items() if not k.startswith("claim_status_step") and k != "uploaded_documents"}
 
-    # Ensure Claim Status defaults to New Claim when missing or user said 'no'
-    if not clean_data.get("Claim Status") and not clean_data.get("Claim_Status"):
-        clean_data["Claim Status"] = "New Claim"
-        clean_data["Claim_Status"] = "New Claim"
-
-    # Ensure compensation amount exists (compute if missing)
-    if not clean_data.get("Compensation Amount") and not clean_data.get("Compensation_Amount"):
-        comp_val = compute_compensation_amount(clean_data)
-        if comp_val:
-            clean_data["Compensation Amount"] = comp_val
-            clean_data["Compensation_Amount"] = comp_val
+    # Ensure Claim Status defaults to New Claim when missing or user said 'no', and
+    # compensation amount exists (reuses the session's cached value unless inputs changed)
+    _fill_derived(session_id, clean_data, ["Claim Status", "Compensation Amount"])
 
     # Uploaded documents (if any)
     documents = session_data.get("uploaded_documents", [])
@@ -1640,10 +2659,7 @@ async def submit_final_claim(request: Request):
     if not ZOHO_ENABLED:
         print("Zoho disabled - would send:", clean_data)
         # Clear session for test flow
-        try:
-            del _sessions[session_id]
-        except Exception:
-            pass
+        _drop_session(session_id)
         return {"success": True, "message": "Claim submitted (test mode)", "claim_id": f"TEST_{session_id[:8]}", "documents_count": len(documents)}
 
     # Build Zoho payload: normalize keys to underscore form expected by zoho_client
@@ -1684,10 +2700,7 @@ async def submit_final_claim(request: Request):
             print("attach_file error for", doc, e)
 
     # Clean up session
-    try:
-        del _sessions[session_id]
-    except Exception:
-        pass
+    _drop_session(session_id)
 
     return {
         "success": True,
@@ -1731,6 +2744,23 @@ FIRST_PROMPT_TEXT = (
     "and I’m here to help you resolve it. Let’s get started."
 )
 
+def _static_prompt_texts() -> List[str]:
+    """The first prompt, every fixed prompt main_convo can speak and the prompt template fragments."""
+    texts = [FIRST_PROMPT_TEXT]
+    if main_convo and hasattr(main_convo, "get_static_prompts"):
+        texts += [t for t in main_convo.get_static_prompts() if t != FIRST_PROMPT_TEXT]
+    texts += _template_fragment_texts()
+    seen = set()
+    return [t for t in texts if not (t in seen or seen.add(t))]
+
+def _pin_prompt_audio() -> None:
+    """Keep the first prompt and all static prompts in TTS_CACHE regardless of budget."""
+    TTS_CACHE.pin(_FIRST_PROMPT_KEY)
+    for text in _static_prompt_texts():
+        TTS_CACHE.pin(_tts_cache_key(text))
+
+_pin_prompt_audio()
+
 def _generate_and_cache_first_prompt() -> Tuple[bytes, str]:
     """
     Generate the 'first prompt' audio and store it in the TTS_CACHE under a reserved key.
@@ -1740,18 +2770,68 @@ def _generate_and_cache_first_prompt() -> Tuple[bytes, str]:
     TTS_CACHE[_FIRST_PROMPT_KEY] = {"bytes": audio_bytes, "media_type": media_type}
     return audio_bytes, media_type
 
+# Every static prompt (first prompt first) is synthesised in the background at startup
+# with bounded concurrency. Startup does not wait for it; /ready reports tts_warm once
+# all of them are cached.
+TTS_PREWARM = os.getenv("TTS_PREWARM", "1").lower() not in ("0", "false", "no", "off")
+TTS_PREWARM_CONCURRENCY = int(os.getenv("TTS_PREWARM_CONCURRENCY", "4"))
+TTS_PREWARM_STATE: Dict[str, Any] = {"state": "pending", "total": 0, "done": 0, "failed": 0, "seconds": None}
+_prewarm_task: Optional[asyncio.Task] = None
+
+async def _prewarm_tts() -> None:
+    texts = _static_prompt_texts()
+    state = TTS_PREWARM_STATE
+    state.update(state="running", total=len(texts), done=0, failed=0, seconds=None)
+    started = time.monotonic()
+    sem = asyncio.Semaphore(max(1, TTS_PREWARM_CONCURRENCY))
+
+    async def warm(text: str) -> None:
+        async with sem:
+            try:
+                if text == FIRST_PROMPT_TEXT:
+                    await asyncio.to_thread(_generate_and_cache_first_prompt)
+                else:
+                    await cached_tts_async(text)
+            except Exception as e:
+                print(f"[tts-prewarm] failed for {text[:40]!r}: {e}")
+        # cached_tts answers failures with uncached placeholder audio
+        if TTS_CACHE.get(_tts_cache_key(text)) is not None:
+            state["done"] += 1
+        else:
+            state["failed"] += 1
+
+    await asyncio.gather(*(warm(t) for t in texts))
+    state["state"] = "warm" if not state["failed"] else "partial"
+    state["seconds"] = round(time.monotonic() - started, 3)
+    print(f"[tts-prewarm] {state['done']}/{state['total']} prompts cached in {state['seconds']}s")
+
 @app.on_event("startup")
-def _startup_prepare_first_prompt() -> None:
-    """
-    Ensure the first prompt is generated at server startup so the frontend can fetch it immediately.
-    """
-    try:
-        _generate_and_cache_first_prompt()
-    except Exception:
-        traceback.print_exc()
+async def _startup_prewarm_tts() -> None:
+    """Start synthesising prompt audio in the background (first prompt first)."""
+    global _prewarm_task
+    if not TTS_PREWARM:
+        TTS_PREWARM_STATE["state"] = "disabled"
+        return
+    if not ELEVEN_API_KEY or not ELEVEN_VOICE_ID:
+        TTS_PREWARM_STATE["state"] = "unconfigured"
+        return
+    _prewarm_task = asyncio.create_task(_prewarm_tts())
+
+@app.on_event("shutdown")
+async def _shutdown_prewarm_tts() -> None:
+    if _prewarm_task is not None and not _prewarm_task.done():
+        _prewarm_task.cancel()
+    if _tts_transcoder is not None:
+        _tts_transcoder.shutdown()
+    _tts_template_executor.shutdown(wait=False, cancel_futures=True)
+
+@app.get("/ready")
+def ready():
+    """Readiness: the API serves requests immediately; tts_warm turns true once all prompt audio is cached."""
+    return {"ready": True, "tts_warm": TTS_PREWARM_STATE["state"] == "warm", "tts_prewarm": TTS_PREWARM_STATE}
 
 @app.get("/first-prompt")
-def first_prompt():
+def first_prompt(request: Request):
     """
     Return pre-generated initial audio (first prompt). If missing, generate on demand.
     """
@@ -1760,8 +2840,8 @@ def first_prompt():
         audio = entry["bytes"]
         media_type = entry.get("media_type", "audio/wav")
     else:
-        audio, media_type = _generate_and_cache_first_prompt()
-    return StreamingResponse(io.BytesIO(audio), media_type=media_type, headers={"Content-Length": str(len(audio))})
+        audio, media_type = _tts_cached_audio(FIRST_PROMPT_TEXT) or _generate_and_cache_first_prompt()
+    return _tts_http_response(request, FIRST_PROMPT_TEXT, audio, media_type)
 
 @app.post("/trigger-first")
 def trigger_first():
@@ -0,0 +1,102 @@
+"""
+On-disk snapshots of the in-memory conversation sessions.
+
+The server keeps every conversation in a module-level dict, so a redeploy or a
+free-tier sleep used to throw away claims that were still being collected.
+These helpers write the live sessions to a single compact file on shutdown and
+read them back on startup, dropping anything older than the session TTL.
+
+msgpack is used when installed; otherwise the snapshot falls back to JSON.
+Both formats are read back transparently.
+"""
+import os
+import json
+import time
+from typing import Dict, Any, Optional, Tuple
+
+# optional msgpack for a smaller / faster snapshot
+try:
+    import msgpack
+except Exception:
+    msgpack = None
+
+SNAPSHOT_VERSION = 1
+
+
+def _encode(payload: Dict[str, Any]) -> bytes:
+    if msgpack is not None:
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _decode(raw: bytes) -> Dict[str, Any]:
+    # JSON snapshots always start with "{"; a msgpack map never does
+    if raw[:1] == b"{":
+        return json.loads(raw.decode("utf-8"))
+    if msgpack is None:
+        raise ValueError("snapshot is msgpack-encoded but msgpack is not installed")
+    return msgpack.unpackb(raw, raw=False)
+
+
+def write_snapshot(
+    path: str,
+    sessions: Dict[str, Dict[str, Any]],
+    touched: Dict[str, float],
+    versions: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> int:
+    """
+    Atomically write sessions (with last-activity timestamps and version state) to path.
+    Returns the number of sessions written.
+    """
+    now = time.time()
+    versions = versions or {}
+    rows = [[sid, touched.get(sid, now), data, versions.get(sid)] for sid, data in sessions.items()]
+    payload = {"v": SNAPSHOT_VERSION, "written_at": now, "sessions": rows}
+    raw = _encode(payload)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(raw)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
+    return len(rows)
+
+
+def read_snapshot(
+    path: str, ttl_seconds: float, now: Optional[float] = None
+) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, float], Dict[str, Dict[str, Any]], int]:
+    """
+    Load a snapshot written by write_snapshot.
+    Returns (sessions, touched, versions, expired_count). Sessions idle for longer
+    than ttl_seconds are skipped. A missing file yields empty results.
+    """
+    if not path or not os.path.isfile(path):
+        return {}, {}, {}, 0
+    with open(path, "rb") as fh:
+        raw = fh.read()
+    if not raw:
+        return {}, {}, {}, 0
+
+    payload = _decode(raw)
+    if payload.get("v") != SNAPSHOT_VERSION:
+        raise ValueError(f"unsupported snapshot version: {payload.get('v')}")
+
+    now = time.time() if now is None else now
+    cutoff = now - ttl_seconds if ttl_seconds and ttl_seconds > 0 else None
+    sessions: Dict[str, Dict[str, Any]] = {}
+    touched: Dict[str, float] = {}
+    versions: Dict[str, Dict[str, Any]] = {}
+    expired = 0
+    for row in payload.get("sessions") or []:
+        sid, ts, data = row[0], row[1], row[2]
+        if cutoff is not None and ts < cutoff:
+            expired += 1
+            continue
+        sessions[sid] = data
+        touched[sid] = ts
+        if len(row) > 3 and row[3]:
+            versions[sid] = row[3]
+    return sessions, touched, versions, expired
@@ -0,0 +1,345 @@
+"""
+Speech-to-text service used by /stt, /conversation/respond and /conversation/stream.
+
+Every endpoint transcribes through one STTBackend selected by STT_BACKEND:
+  elevenlabs  ElevenLabs scribe over the shared async HTTP client (default)
+  mock        local, deterministic transcripts with configurable latency, for
+              load-testing the whole turn pipeline without the paid API
+
+ResilientSTT wraps a backend with request hedging (a second identical request
+once the first is slower than a recent latency percentile) and a circuit
+breaker that fails fast while the upstream error rate is high.
+"""
+import abc
+import time
+import asyncio
+import hashlib
+import random
+import threading
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import httpx
+
+from .audio_pipeline import multipart_stream, TranscodeError, ReplayableStream
+
+ELEVEN_STT_URL = "https://api.elevenlabs.io/v1/speech-to-text"
+
+
+class STTError(RuntimeError):
+    """Upstream transcription failed; status is the upstream HTTP status (None if unreachable)."""
+
+    def __init__(self, detail: str, status: Optional[int] = None):
+        super().__init__(detail)
+        self.detail = detail
+        self.status = status
+
+
+class CircuitOpenError(STTError):
+    """Raised without calling upstream while the circuit breaker is open."""
+
+
+def stt_text_from_body(body: Dict[str, Any]) -> str:
+    """Transcript from an STT JSON response, whichever key the provider used."""
+    return (
+        body.get("text")
+        or body.get("transcript")
+        or body.get("transcription")
+        or (body.get("results") and body["results"][0].get("text"))
+        or ""
+    )
+
+
+class STTBackend(abc.ABC):
+    name = "base"
+
+    @property
+    def model_id(self) -> str:
+        """Identifies the transcription model (part of the transcript cache key)."""
+        return self.name
+
+    @property
+    def configured(self) -> bool:
+        return True
+
+    @abc.abstractmethod
+    async def transcribe(self, chunks: AsyncIterator[bytes], filename: str, content_type: str) -> str:
+        """Transcribe a stream of audio bytes. Raises STTError on failure."""
+
+
+class ElevenLabsSTT(STTBackend):
+    name = "elevenlabs"
+
+    def __init__(self, api_key: Optional[str], model: str, get_client: Callable[[], httpx.AsyncClient]):
+        self.api_key = api_key
+        self.model = model
+        self._get_client = get_client
+
+    @property
+    def model_id(self) -> str:
+        return self.model
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.api_key)
+
+    async def transcribe(self, chunks: AsyncIterator[bytes], filename: str, content_type: str) -> str:
+        body, multipart_type = multipart_stream({"model_id": self.model}, "file", filename, content_type, chunks)
+        headers = {"xi-api-key": self.api_key, "Accept": "application/json", "Content-Type": multipart_type}
+        try:
+            resp = await self._get_client().post(ELEVEN_STT_URL, headers=headers, content=body)
+        except (httpx.HTTPError, TranscodeError) as e:
+            print("ElevenLabs STT connection error:", e)
+            raise STTError(str(e))
+        if resp.status_code >= 400:
+            print("ElevenLabs STT error:", resp.status_code, resp.text)
+            raise STTError(resp.text, resp.status_code)
+        return stt_text_from_body(resp.json()).strip()
+
+
+# canned answers covering the intake script, picked by audio hash when no fixed text is set
+MOCK_TRANSCRIPTS: List[str] = [
+    "My name is Jane Smith. I was flying with British Airways, flight BA 123 on 5 May 2024 "
+    "from LHR to CDG and we were delayed 4 hours.",
+    "jane.smith@example.com",
+    "My booking reference is ABC123.",
+    "The flight was delayed because of a technical problem.",
+    "no",
+]
+
+
+class MockSTT(STTBackend):
+    """
+    Reads the whole audio stream like a real upload, waits latency_ms (+ up to
+    jitter_ms) and returns a transcript that depends only on the audio bytes.
+    """
+
+    name = "mock"
+
+    def __init__(self, latency_ms: float = 0.0, jitter_ms: float = 0.0, text: Optional[str] = None):
+        self.latency_ms = max(0.0, latency_ms)
+        self.jitter_ms = max(0.0, jitter_ms)
+        self.text = text
+
+    async def transcribe(self, chunks: AsyncIterator[bytes], filename: str, content_type: str) -> str:
+        digest = hashlib.blake2b(digest_size=8)
+        try:
+            async for chunk in chunks:
+                digest.update(chunk)
+        except TranscodeError as e:
+            raise STTError(str(e))
+        seed = int.from_bytes(digest.digest(), "big")
+        delay = self.latency_ms + (random.Random(seed).random() * self.jitter_ms if self.jitter_ms else 0.0)
+        if delay:
+            await asyncio.sleep(delay / 1000.0)
+        if self.text is not None:
+            return self.text
+        return MOCK_TRANSCRIPTS[seed % len(MOCK_TRANSCRIPTS)]
+
+
+def create_stt_backend(kind: str, **options: Any) -> STTBackend:
+    """
+    kind: "elevenlabs" (options: api_key, model, get_client) or
+          "mock" (options: latency_ms, jitter_ms, text)
+    """
+    kind = (kind or "elevenlabs").strip().lower()
+    if kind == "mock":
+        return MockSTT(options.get("latency_ms", 0.0), options.get("jitter_ms", 0.0), options.get("text"))
+    if kind == "elevenlabs":
+        return ElevenLabsSTT(options.get("api_key"), options.get("model", "scribe_v1"), options["get_client"])
+    raise ValueError(f"unknown STT backend: {kind!r}")
+
+
+class CircuitBreaker:
+    """
+    Opens when at least failure_ratio of the last window calls failed (once min_calls
+    have been seen). After open_seconds one probe call is let through (half-open):
+    success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, failure_ratio: float = 0.5, window: int = 20, min_calls: int = 5, open_seconds: float = 30.0):
+        self.failure_ratio = failure_ratio
+        self.min_calls = max(1, min_calls)
+        self.open_seconds = open_seconds
+        self._outcomes: deque = deque(maxlen=max(1, window))
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self.times_opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if self._probing or time.monotonic() - self._opened_at >= self.open_seconds:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self._opened_at >= self.open_seconds:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, success: bool) -> None:
+        with self._lock:
+            if self._probing:
+                self._probing = False
+                if success:
+                    self._opened_at = None
+                    self._outcomes.clear()
+                else:
+                    self._opened_at = time.monotonic()
+                    self.times_opened += 1
+                    print("[stt] circuit breaker re-opened: half-open probe failed")
+                return
+            self._outcomes.append(success)
+            failures = self._outcomes.count(False)
+            if (self._opened_at is None and len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.failure_ratio):
+                self._opened_at = time.monotonic()
+                self.times_opened += 1
+                print(f"[stt] circuit breaker open: {failures}/{len(self._outcomes)} recent calls failed")
+
+    def reject(self) -> None:
+        """Count a call turned away by the caller after checking state."""
+        with self._lock:
+            self.rejected += 1
+
+    def release_probe(self) -> None:
+        """Let another half-open probe through (the current one ended without a verdict)."""
+        with self._lock:
+            self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "recent_calls": len(self._outcomes),
+            "recent_failures": self._outcomes.count(False),
+            "times_opened": self.times_opened,
+            "rejected": self.rejected,
+        }
+
+
+class ResilientSTT(STTBackend):
+    """
+    Hedging + circuit breaking around another backend.
+
+    If the first request has not finished after the hedge_percentile of recent
+    successful latencies (initial_delay_ms until min_samples are known, never less
+    than min_delay_ms), an identical second request is sent and whichever succeeds
+    first wins; the other is cancelled. Each logical call counts once for the breaker.
+    """
+
+    def __init__(
+        self,
+        inner: STTBackend,
+        breaker: CircuitBreaker,
+        hedge: bool = True,
+        hedge_percentile: float = 95.0,
+        min_delay_ms: float = 500.0,
+        initial_delay_ms: float = 3000.0,
+        min_samples: int = 20,
+    ):
+        self.inner = inner
+        self.breaker = breaker
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.min_delay_ms = min_delay_ms
+        self.initial_delay_ms = initial_delay_ms
+        self.min_samples = min_samples
+        self._latencies: deque = deque(maxlen=200)
+        self.calls = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+
+    @property
+    def name(self) -> str:
+        return self.inner.name
+
+    @property
+    def model_id(self) -> str:
+        return self.inner.model_id
+
+    @property
+    def configured(self) -> bool:
+        return self.inner.configured
+
+    def hedge_delay(self) -> float:
+        """Seconds to wait for the first request before hedging."""
+        if len(self._latencies) < self.min_samples:
+            return max(self.initial_delay_ms, self.min_delay_ms) / 1000.0
+        ordered = sorted(self._latencies)
+        idx = min(len(ordered) - 1, int(round(self.hedge_percentile / 100.0 * (len(ordered) - 1))))
+        return max(ordered[idx], self.min_delay_ms / 1000.0)
+
+    async def transcribe(self, chunks: AsyncIterator[bytes], filename: str, content_type: str) -> str:
+        if not self.breaker.allow():
+            raise CircuitOpenError("STT temporarily unavailable (circuit open)")
+        self.calls += 1
+        try:
+            if self.hedge:
+                text = await self._hedged(chunks, filename, content_type)
+            else:
+                started = time.monotonic()
+                text = await self.inner.transcribe(chunks, filename, content_type)
+                self._latencies.append(time.monotonic() - started)
+        except STTError:
+            self.breaker.record(False)
+            raise
+        except BaseException:
+            # caller went away, or the audio stream itself failed: no verdict on the upstream
+            self.breaker.release_probe()
+            raise
+        self.breaker.record(True)
+        return text
+
+    async def _hedged(self, chunks: AsyncIterator[bytes], filename: str, content_type: str) -> str:
+        tee = ReplayableStream(chunks)
+        started = {}
+
+        def launch() -> asyncio.Task:
+            task = asyncio.ensure_future(self.inner.transcribe(tee.reader(), filename, content_type))
+            started[task] = time.monotonic()
+            return task
+
+        primary = launch()
+        pending = {primary}
+        error: Optional[BaseException] = None
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_delay())
+            if not done:
+                self.hedges_fired += 1
+                pending.add(launch())
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedges_won += 1
+                        self._latencies.append(time.monotonic() - started[task])
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        ordered = sorted(self._latencies)
+        return {
+            "backend": self.name,
+            "calls": self.calls,
+            "hedging": self.hedge,
+            "hedge_delay_ms": round(self.hedge_delay() * 1000, 1),
+            "hedges_fired": self.hedges_fired,
+            "hedges_won": self.hedges_won,
+            "latency_p50_ms": round(ordered[len(ordered) // 2] * 1000, 1) if ordered else None,
+            "breaker": self.breaker.stats(),
+        }
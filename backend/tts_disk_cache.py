@@ -0,0 +1,187 @@
+"""
+Content-addressed TTS audio cache on disk, shared by all workers on a host.
+
+Files are named by sha256(text, voice id, voice settings) and written atomically
+(temp file in the same directory + os.replace), so concurrent workers can
+read/write the same directory without locks: the worst case is two workers
+synthesizing the same text once each. Hits refresh the file atime (mtime is left
+alone so validators derived from it stay stable); when the directory grows past
+max_bytes the least recently used files are removed.
+
+File and byte totals are running counters: taken from a directory scan (the first
+stats() call, and every prune) and updated by this process's writes in between, so
+writes by other workers show up at the next prune.
+"""
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+# media type <-> file extension; lookup probes these in order
+_EXTENSIONS = {
+    "audio/mpeg": ".mp3",
+    "audio/wav": ".wav",
+    "audio/webm": ".webm",
+    "audio/ogg": ".ogg",
+    "application/octet-stream": ".bin",
+}
+_MEDIA_TYPES = {ext: media for media, ext in _EXTENSIONS.items()}
+
+# prune at most every this many writes (a full directory scan)
+_PRUNE_EVERY = 64
+
+
+def tts_cache_key(text: str, voice_id: str, voice_settings: Dict[str, Any]) -> str:
+    raw = json.dumps([text, voice_id, voice_settings], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class DiskAudioCache:
+    def __init__(self, root: str, max_bytes: int = 0):
+        """root: cache directory (created on demand); max_bytes: 0 = unbounded."""
+        self.root = root
+        self.max_bytes = max(0, int(max_bytes))
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.pruned = 0
+        self._lock = threading.Lock()
+        self._files: Optional[int] = None  # None until the first scan
+        self._bytes = 0
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.root, key[:2], key + ext)
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """Return (path, media type) for a cached key, or None."""
+        for ext, media in _MEDIA_TYPES.items():
+            path = self._path(key, ext)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            try:
+                os.utime(path, (time.time(), st.st_mtime))
+            except OSError:
+                pass
+            self.hits += 1
+            return path, media
+        self.misses += 1
+        return None
+
+    def read(self, key: str) -> Optional[Tuple[bytes, str]]:
+        entry = self.get(key)
+        if entry is None:
+            return None
+        try:
+            with open(entry[0], "rb") as fh:
+                return fh.read(), entry[1]
+        except FileNotFoundError:
+            # pruned by another worker in between
+            return None
+
+    def put(self, key: str, data: bytes, media_type: str) -> Optional[str]:
+        """Store audio atomically; returns the file path (None if the write failed)."""
+        ext = _EXTENSIONS.get(media_type, ".bin")
+        path = self._path(key, ext)
+        tmp = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+            try:
+                replaced = os.stat(path).st_size
+            except FileNotFoundError:
+                replaced = None
+            os.replace(tmp, path)
+        except OSError as e:
+            print("[tts-disk-cache] write failed:", e)
+            if tmp:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+            return None
+        self.writes += 1
+        self._writes += 1
+        with self._lock:
+            if self._files is not None:
+                if replaced is None:
+                    self._files += 1
+                    self._bytes += len(data)
+                else:
+                    self._bytes += len(data) - replaced
+        if self.max_bytes and self._writes >= _PRUNE_EVERY:
+            self._writes = 0
+            self.prune()
+        return path
+
+    def _scan(self):
+        files = []
+        try:
+            shards = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return files
+        for shard in shards:
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.startswith(".tmp-"):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((max(st.st_atime, st.st_mtime), st.st_size, entry.path))
+        return files
+
+    def prune(self) -> int:
+        """Remove least recently used files until under max_bytes. Returns files removed."""
+        if not self.max_bytes:
+            return 0
+        files = self._scan()
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.pruned += removed
+        with self._lock:
+            self._files, self._bytes = len(files) - removed, total
+        return removed
+
+    def _totals(self) -> Tuple[int, int]:
+        with self._lock:
+            if self._files is not None:
+                return self._files, self._bytes
+        files = self._scan()
+        with self._lock:
+            if self._files is None:
+                self._files, self._bytes = len(files), sum(size for _, size, _ in files)
+            return self._files, self._bytes
+
+    def stats(self) -> Dict[str, Any]:
+        files, bytes_used = self._totals()
+        lookups = self.hits + self.misses
+        return {
+            "root": self.root,
+            "files": files,
+            "bytes_used": bytes_used,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "pruned": self.pruned,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,163 @@
+"""
+Alternative encodings of synthesized audio, chosen by the request's Accept header.
+
+ElevenLabs returns MP3 (or WAV); clients that accept it can get Opus instead, which
+is several times smaller at speech quality. Variants are produced by ffmpeg once per
+cached source clip on a small background worker pool; until a variant exists the
+source format is served, so no request ever waits for a transcode.
+"""
+import os
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from .audio_pipeline import FFMPEG_BIN
+from .cache_utils import TTLCache
+
+# media type -> (file suffix, ffmpeg encoder, ffmpeg muxer); in order of preference on ties
+VARIANT_FORMATS = {
+    "audio/webm": (".webm", "libopus", "webm"),
+    "audio/ogg": (".ogg", "libopus", "ogg"),
+}
+
+
+def _parse_accept(accept: str):
+    for item in accept.split(","):
+        media, _, params = item.strip().partition(";")
+        media = media.strip().lower()
+        if not media:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        yield media, q
+
+
+def _accept_quality(entries, media_type: str) -> Tuple[float, int]:
+    """(q, specificity) of the most specific Accept entry matching media_type; specificity -1 = no match."""
+    major = media_type.split("/")[0]
+    best = (0.0, -1)
+    for media, q in entries:
+        if media == media_type:
+            spec = 2
+        elif media == major + "/*":
+            spec = 1
+        elif media == "*/*":
+            spec = 0
+        else:
+            continue
+        if spec > best[1]:
+            best = (q, spec)
+    return best
+
+
+def negotiate(accept: Optional[str], source_media: str, variants: Iterable[str] = VARIANT_FORMATS) -> str:
+    """
+    Media type to serve: a variant only when the client prefers it to the source
+    format (higher q, or equal q with a more specific match, e.g. listed explicitly
+    vs. matched by audio/* or */*). No Accept header, or plain */*, means the source.
+    """
+    if not accept:
+        return source_media
+    entries = list(_parse_accept(accept))
+    best, best_rank = source_media, _accept_quality(entries, source_media)
+    for media in variants:
+        if media == source_media:
+            continue
+        rank = _accept_quality(entries, media)
+        if rank[0] > 0 and rank > best_rank:
+            best, best_rank = media, rank
+    return best
+
+
+def format_media_type(fmt: Optional[str]) -> Optional[str]:
+    """Media type for an explicit format opt-in by file suffix ("webm", "ogg"), or None."""
+    fmt = (fmt or "").strip().lower().lstrip(".")
+    for media, (suffix, _, _) in VARIANT_FORMATS.items():
+        if suffix.lstrip(".") == fmt:
+            return media
+    return None
+
+
+def transcode(data: bytes, media_type: str, bitrate: str = "32k") -> Optional[bytes]:
+    """Encode data to a VARIANT_FORMATS media type with ffmpeg; None on failure."""
+    suffix, codec, muxer = VARIANT_FORMATS[media_type]
+    # a seekable output file lets the muxer write duration / cues
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        done = subprocess.run(
+            [FFMPEG_BIN, "-hide_banner", "-loglevel", "error", "-y", "-i", "pipe:0", "-vn",
+             "-c:a", codec, "-b:a", bitrate, "-ac", "1", "-f", muxer, path],
+            input=data, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60,
+        )
+        if done.returncode != 0:
+            print(f"[tts-variants] ffmpeg failed ({media_type}):", done.stderr.decode(errors="ignore")[-300:])
+            return None
+        with open(path, "rb") as fh:
+            out = fh.read()
+        return out or None
+    except (OSError, subprocess.TimeoutExpired) as e:
+        print(f"[tts-variants] transcode to {media_type} failed:", e)
+        return None
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+class TranscodePool:
+    """
+    Runs transcodes on a bounded thread pool, at most once per (key, media type) at a
+    time; store(key, media_type, data) receives each finished variant.
+    A failed job is not retried for retry_seconds.
+    """
+
+    def __init__(self, store: Callable[[str, str, bytes], None], workers: int = 2, bitrate: str = "32k",
+                 retry_seconds: float = 600.0):
+        self._store = store
+        self.bitrate = bitrate
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="tts-transcode")
+        self._lock = threading.Lock()
+        self._pending: set = set()
+        self._failed = TTLCache(4096, retry_seconds)
+        self.done = 0
+        self.failed = 0
+
+    def submit(self, key: str, source: bytes, media_type: str) -> bool:
+        """Queue a transcode unless one is pending or failed for this key. Returns True if queued."""
+        job = (key, media_type)
+        with self._lock:
+            if job in self._pending or job in self._failed:
+                return False
+            self._pending.add(job)
+        self._pool.submit(self._run, job, source)
+        return True
+
+    def _run(self, job: Tuple[str, str], source: bytes) -> None:
+        key, media_type = job
+        try:
+            out = transcode(source, media_type, self.bitrate)
+            if out is not None:
+                self._store(key, media_type, out)
+                self.done += 1
+            else:
+                self._failed.set(job, True)
+                self.failed += 1
+        finally:
+            with self._lock:
+                self._pending.discard(job)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"pending": len(self._pending), "done": self.done, "failed": self.failed}
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
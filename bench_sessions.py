@@ -0,0 +1,292 @@
+"""
+Session capacity / memory-footprint benchmark for the conversation API.
+
+Creates sessions through /conversation/start, fills each one with a scripted
+set of /conversation/respond turns (mock STT backend, TTS / Zoho mocked out) and reports,
+at every requested session count:
+  - RSS growth and RSS bytes per live session
+  - deep size of the per-session server state (sampled)
+  - turn latency percentiles measured while that many sessions are live
+
+Usage:
+    python bench_sessions.py                      # 1k, 10k, 100k sessions
+    python bench_sessions.py --levels 1000 5000 --output bench_sessions.json
+    python bench_sessions.py --stt-latency-ms 400 --stt-jitter-ms 200
+"""
+import os
+import io
+import sys
+import gc
+import json
+import time
+import math
+import wave
+import array
+import random
+import asyncio
+import argparse
+import platform
+import contextlib
+import datetime
+from typing import Any, Dict, List
+
+# never touch a real snapshot file or the real upstreams from a benchmark
+os.environ["SESSION_SNAPSHOT_PATH"] = ""
+os.environ["TTS_DISK_CACHE_DIR"] = ""
+os.environ["ELEVEN_API_KEY"] = "bench"
+os.environ["ELEVEN_VOICE_ID"] = "bench"
+os.environ.pop("ZOHO_CLIENT_ID", None)
+os.environ["STT_BACKEND"] = "mock"
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from backend import server_api  # noqa: E402
+
+OPEN_ENDED = (
+    "My name is Jane Smith. I was flying with British Airways, flight BA 123 on 5 May 2024 "
+    "from LHR to CDG and we were delayed 4 hours."
+)
+# (kind, content): audio turns go through the mock STT backend, text turns post JSON
+SCRIPT = [
+    ("audio", OPEN_ENDED),
+    ("text", "jane.smith@example.com"),
+    ("text", "no"),
+]
+
+
+def _tone_wav(seconds: float = 0.5, rate: int = 16000) -> bytes:
+    # loud enough to pass the audio quality gate and VAD
+    frame = array.array("h", (int(8000 * math.sin(2 * math.pi * 220 * i / rate)) for i in range(int(rate * seconds))))
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(rate)
+        wf.writeframes(frame.tobytes())
+    return buf.getvalue()
+
+
+def _unique(wav: bytes) -> bytes:
+    """Vary the last samples so every upload misses the STT transcript cache."""
+    return wav[:-8] + os.urandom(8)
+
+
+class _FakeResponse:
+    def __init__(self, status_code: int, payload: Any = None, content: bytes = b""):
+        self.status_code = status_code
+        self._payload = payload
+        self.content = content
+        self.text = json.dumps(payload) if payload is not None else ""
+        self.headers = {"Content-Type": "application/json" if payload is not None else "audio/mpeg"}
+
+    def json(self):
+        return self._payload
+
+    def iter_content(self, chunk_size: int = 1):
+        # TTS is always read as a stream (see server_api._TTSFill)
+        yield self.content
+
+    def close(self) -> None:
+        pass
+
+
+# canned TTS audio; must differ from server_api._make_dummy_mp3(), which the server treats
+# as a failed synthesis (never cached over HTTP, not inlined or chunked)
+FAKE_MP3 = b"\xff\xfb\x90\x64" + b"\x55" * 2048
+
+
+def _install_mocks() -> None:
+    """Replace the upstream HTTP calls made by the server with canned responses."""
+    def fake_post(url, *args, **kwargs):
+        return _FakeResponse(200, content=FAKE_MP3)
+
+    def fake_async(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200, content=FAKE_MP3, headers={"Content-Type": "audio/mpeg"})
+
+    server_api.requests.post = fake_post
+    server_api._stt_backend.text = OPEN_ENDED
+    server_api._http_client = httpx.AsyncClient(transport=httpx.MockTransport(fake_async))
+    server_api.ELEVEN_API_KEY = "bench"
+    server_api.ELEVEN_VOICE_ID = "bench"
+    server_api.ZOHO_ENABLED = False
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/status") as fh:
+            for line in fh:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _deep_size(obj: Any, seen: set) -> int:
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += _deep_size(k, seen) + _deep_size(v, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += _deep_size(item, seen)
+    return size
+
+
+def _session_state_bytes(session_ids: List[str], sample: int) -> float:
+    """Average deep size of everything the server keeps per session (sampled)."""
+    if not session_ids:
+        return 0.0
+    picked = random.sample(session_ids, min(sample, len(session_ids)))
+    stores = [
+        getattr(server_api, name)
+        for name in ("_sessions", "_session_touched", "_session_versions", "_session_derived")
+        if hasattr(server_api, name)
+    ]
+    total = 0
+    for sid in picked:
+        seen: set = set()
+        total += sys.getsizeof(sid)
+        for store in stores:
+            if sid in store:
+                # dict slot overhead is amortised; count key + value
+                total += _deep_size(store[sid], seen) + 8
+    return total / len(picked)
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    s = sorted(samples)
+
+    def pct(p: float) -> float:
+        idx = min(len(s) - 1, max(0, int(round(p / 100.0 * (len(s) - 1)))))
+        return round(s[idx] * 1000, 3)
+
+    return {
+        "count": len(s),
+        "p50_ms": pct(50),
+        "p90_ms": pct(90),
+        "p99_ms": pct(99),
+        "max_ms": round(s[-1] * 1000, 3),
+        "mean_ms": round(sum(s) / len(s) * 1000, 3),
+    }
+
+
+async def _run_conversation(client: httpx.AsyncClient, wav: bytes, latencies: List[float] = None) -> str:
+    r = await client.post("/conversation/start")
+    session_id = r.json()["session_id"]
+    for kind, content in SCRIPT:
+        started = time.perf_counter()
+        if kind == "audio":
+            r = await client.post(
+                "/conversation/respond",
+                params={"session_id": session_id},
+                files={"file": ("turn.wav", _unique(wav), "audio/wav")},
+            )
+        else:
+            r = await client.post("/conversation/respond", params={"session_id": session_id}, json={"text": content})
+        if latencies is not None:
+            latencies.append(time.perf_counter() - started)
+        if r.status_code != 200 or "error" in r.json():
+            raise RuntimeError(f"turn failed: {r.status_code} {r.text[:200]}")
+    return session_id
+
+
+async def run(levels: List[int], probe: int, concurrency: int, sample: int) -> Dict[str, Any]:
+    _install_mocks()
+    wav = _tone_wav()
+    transport = httpx.ASGITransport(app=server_api.app)
+    results = []
+    session_ids: List[str] = []
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        # warm up imports / regex caches before taking the baseline
+        server_api._drop_session(await _run_conversation(client, wav))
+        gc.collect()
+        baseline_rss = _rss_bytes()
+
+        for level in sorted(levels):
+            started = time.perf_counter()
+            sem = asyncio.Semaphore(concurrency)
+
+            async def one():
+                async with sem:
+                    session_ids.append(await _run_conversation(client, wav))
+
+            missing = level - len(server_api._sessions)
+            # create in batches so the pending-task list stays small at 100k
+            batch = max(concurrency * 50, 1)
+            while missing > 0:
+                n = min(batch, missing)
+                await asyncio.gather(*(one() for _ in range(n)))
+                missing -= n
+            fill_seconds = time.perf_counter() - started
+
+            gc.collect()
+            rss = _rss_bytes()
+            live = len(server_api._sessions)
+
+            # latency probe: sequential turns on fresh sessions while `level` sessions are live
+            latencies: List[float] = []
+            for _ in range(max(1, probe // len(SCRIPT))):
+                sid = await _run_conversation(client, wav, latencies)
+                server_api._drop_session(sid)
+
+            results.append({
+                "sessions": live,
+                "fill_seconds": round(fill_seconds, 3),
+                "turns_per_second": round(live * len(SCRIPT) / fill_seconds, 1) if fill_seconds else None,
+                "rss_bytes": rss,
+                "rss_growth_bytes": rss - baseline_rss,
+                "rss_bytes_per_session": round((rss - baseline_rss) / live, 1) if live else None,
+                "state_bytes_per_session": round(_session_state_bytes(session_ids, sample), 1),
+                "turn_latency": _percentiles(latencies),
+            })
+            print(f"[bench] {live} sessions: {json.dumps(results[-1])}", file=sys.stderr)
+
+    return {
+        "benchmark": "session_capacity",
+        "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "turns_per_session": len(SCRIPT),
+        "stt": {"backend": server_api._stt_backend.name, "latency_ms": server_api._stt_backend.latency_ms, "jitter_ms": server_api._stt_backend.jitter_ms},
+        "baseline_rss_bytes": baseline_rss,
+        "levels": results,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", type=int, nargs="+", default=[1000, 10000, 100000], help="live session counts to measure at")
+    parser.add_argument("--probe-turns", type=int, default=600, help="turns timed at each level")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent conversations while filling")
+    parser.add_argument("--sample", type=int, default=500, help="sessions sampled for the deep-size estimate")
+    parser.add_argument("--stt-latency-ms", type=float, default=0.0, help="mock STT latency per audio turn")
+    parser.add_argument("--stt-jitter-ms", type=float, default=0.0, help="extra random mock STT latency, up to this much")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    server_api._stt_backend.latency_ms = args.stt_latency_ms
+    server_api._stt_backend.jitter_ms = args.stt_jitter_ms
+
+    # the server logs every turn to stdout; keep that out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        report = asyncio.run(run(args.levels, args.probe_turns, args.concurrency, args.sample))
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(out + "\n")
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    main()